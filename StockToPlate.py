@@ -4,11 +4,11 @@
 """
 Bot Telegram en Python 3 (v20+) avec:
 - Multi-langue (FR/EN/ES) via LANGUAGE.
-- Gestion convives (CSV).
+- Gestion convives (SQLite, migration automatique de l'ancien CSV).
 - Récupération du stock via GET /stock (Grocy).
 - Recherche (fallback) par plusieurs mots ou code-barres (ordre indifférent).
 - Affichage correct du code-barres (ou "Aucun code-barres" si vide).
-- Génération de recette via OpenAI (gpt-4o), envoyant TOUT le stock.
+- Génération de recette via OpenAI (gpt-4o) en streaming, stock classé par péremption (budget de tokens).
 - Émojis, code user-friendly, commentaire en français.
 - drop_pending_updates=True pour ignorer l'historique.
 """
@@ -16,26 +16,55 @@ Bot Telegram en Python 3 (v20+) avec:
 import logging
 import csv
 import os
-import requests
+import io
+import sqlite3
+import threading
+import httpx
 import asyncio
+import time
+import json
+import functools
+import inspect
+import hashlib
+import base64
+import re
+import math
+import secrets
+import sys
+import pickle
+import unicodedata
+import multiprocessing
+import contextvars
 import nest_asyncio
 
-from typing import List, Dict
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+
+from typing import List, Dict, Optional, Callable, Set, AsyncIterator, Tuple, Awaitable
 
 nest_asyncio.apply()  # Évite "event loop already running" dans certains environnements
 
 from telegram import (
     Update,
+    Chat,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
-    KeyboardButton
+    KeyboardButton,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup
 )
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
+    CallbackQueryHandler,
     MessageHandler,
     ConversationHandler,
     ContextTypes,
+    PicklePersistence,
+    PersistenceInput,
     filters
 )
 
@@ -55,11 +84,46 @@ TEXTS = {
         ),
         "start_menu_label": "Pour plus d'actions, tapez /start 🍽️",
         "no_stock_found": "⚠️ Impossible de récupérer Grocy...",
+        "stock_stale": "⚠️ Grocy ne répond pas : stock tel qu'il était il y a {age}.",
         "barcode_not_found": "Aucun produit ne correspond à",
+        "barcode_photo_none": "📷 Aucun code-barres lisible sur la photo. Essayez plus près, bien à plat et éclairé.",
+        "barcode_photo_unavailable": "📷 La lecture de photos n'est pas disponible (pyzbar/Pillow non installés). Tapez le code-barres.",
         "product_updated": "✅ Produit mis à jour dans Grocy avec succès.",
+        "product_gone": "⚠️ Ce produit n'est plus dans le stock Grocy. Relancez la recherche.",
+        "expiring_title": "⏳ Produits périmant d'ici {days} jour(s) :",
+        "expiring_none": "✅ Aucun produit ne périme d'ici {days} jour(s).",
+        "expiring_usage": "Usage : /expiring [jours]",
+        "import_usage": (
+            "Usage : /import suivi d'une ligne par produit (ou, en privé, un fichier .csv "
+            "en réponse à /import ou avec la légende /import) :\n"
+            "code-barres ou nom ; quantité\n"
+            "+3 ajoute, -2 consomme, =5 fixe la quantité (3 seul = +3)."
+        ),
+        "import_running": "📦 Import de {n} produit(s) en cours...",
+        "import_csv_hint": "📎 Fichier non importé : envoyez-le avec la légende /import, ou juste après /import.",
+        "import_summary": "📦 Import terminé : {ok} réussi(s), {failed} échec(s), {skipped} ligne(s) ignorée(s).",
+        "import_bad_line": "format invalide",
+        "import_not_found": "produit introuvable",
+        "import_ambiguous": "plusieurs produits correspondent",
+        "import_failed": "échec Grocy",
+        "import_partial": "stock insuffisant, {done:g} retiré(s) sur {asked:g}",
+        "import_too_long": "⚠️ Trop de lignes : seules les {max} premières sont traitées.",
+        "plan_days": "Planning de combien de jours ? (1-{max})",
+        "plan_generation": "🤖 Génération de {days} recette(s) en parallèle...",
+        "plan_day_title": "📅 Jour {day}/{days}",
+        "plan_shopping_title": "🛒 Liste de courses de la semaine :",
+        "plan_shopping_none": "🛒 Rien à acheter pour ce planning.",
+        "product_update_queued": "⏳ Mise à jour envoyée à Grocy...",
+        "product_update_failed": "❌ Échec de la mise à jour Grocy pour {name}.",
+        "product_consume_empty": "⚠️ {name} : rien n'a été retiré, le stock est vide.",
+        "product_consume_partial": "⚠️ {name} : seulement {done:g} retiré(s), le stock est maintenant vide.",
         "product_to_list": "🛒 Produit ajouté (fictif) à la liste de courses.",
         "choose_quantity": "Quelle quantité voulez-vous ajouter ou retirer ?",
         "recipe_generation": "🤖 Je lance la génération de la recette !",
+        "recipe_cached": "♻️ Recette déjà générée pour ce stock. « 🔄 Regénérer Recette » pour en obtenir une autre.",
+        "recipe_nothing_to_regenerate": "Aucune recette à regénérer.",
+        "search_page_footer": "📄 {page}/{pages} ({n} résultats)",
+        "llm_queued": "⏳ Beaucoup de demandes en cours : vous êtes n°{pos} dans la file, la recette arrive.",
         "invalid_number": "Veuillez envoyer un numéro valide.",
         "invalid_choice": "Choix invalide. Réessayez ou /start pour annuler.",
         # convives
@@ -78,11 +142,46 @@ TEXTS = {
         ),
         "start_menu_label": "For more actions, type /start 🍽️",
         "no_stock_found": "⚠️ Unable to retrieve Grocy...",
+        "stock_stale": "⚠️ Grocy is not responding: stock as it was {age} ago.",
         "barcode_not_found": "No product matches",
+        "barcode_photo_none": "📷 No readable barcode in the photo. Try closer, flat and well lit.",
+        "barcode_photo_unavailable": "📷 Photo scanning is not available (pyzbar/Pillow not installed). Please type the barcode.",
         "product_updated": "✅ Product successfully updated in Grocy.",
+        "product_gone": "⚠️ This product is no longer in the Grocy stock. Please search again.",
+        "expiring_title": "⏳ Products expiring within {days} day(s):",
+        "expiring_none": "✅ No product expires within {days} day(s).",
+        "expiring_usage": "Usage: /expiring [days]",
+        "import_usage": (
+            "Usage: /import followed by one line per product (or, in a private chat, a .csv "
+            "file in reply to /import or with the caption /import):\n"
+            "barcode or name ; quantity\n"
+            "+3 adds, -2 consumes, =5 sets the amount (plain 3 = +3)."
+        ),
+        "import_running": "📦 Importing {n} product(s)...",
+        "import_csv_hint": "📎 File not imported: send it with the caption /import, or right after /import.",
+        "import_summary": "📦 Import done: {ok} succeeded, {failed} failed, {skipped} line(s) skipped.",
+        "import_bad_line": "invalid format",
+        "import_not_found": "product not found",
+        "import_ambiguous": "several products match",
+        "import_failed": "Grocy error",
+        "import_partial": "not enough stock, {done:g} of {asked:g} removed",
+        "import_too_long": "⚠️ Too many lines: only the first {max} are processed.",
+        "plan_days": "Plan for how many days? (1-{max})",
+        "plan_generation": "🤖 Generating {days} recipe(s) in parallel...",
+        "plan_day_title": "📅 Day {day}/{days}",
+        "plan_shopping_title": "🛒 Shopping list for the week:",
+        "plan_shopping_none": "🛒 Nothing to buy for this plan.",
+        "product_update_queued": "⏳ Update sent to Grocy...",
+        "product_update_failed": "❌ Grocy update failed for {name}.",
+        "product_consume_empty": "⚠️ {name}: nothing was removed, the stock is empty.",
+        "product_consume_partial": "⚠️ {name}: only {done:g} removed, the stock is now empty.",
         "product_to_list": "🛒 Product (fictitiously) added to the shopping list.",
         "choose_quantity": "Which quantity do you want to add or remove?",
         "recipe_generation": "🤖 Generating the recipe now!",
+        "recipe_cached": "♻️ Recipe already generated for this stock. Use « 🔄 Regénérer Recette » to get another one.",
+        "recipe_nothing_to_regenerate": "No recipe to regenerate.",
+        "search_page_footer": "📄 {page}/{pages} ({n} results)",
+        "llm_queued": "⏳ Many requests right now: you are #{pos} in the queue, your recipe is coming.",
         "invalid_number": "Please send a valid number.",
         "invalid_choice": "Invalid choice. Retry or /start to cancel.",
         # convives
@@ -101,11 +200,46 @@ TEXTS = {
         ),
         "start_menu_label": "Para más acciones, escribe /start 🍽️",
         "no_stock_found": "⚠️ No se puede recuperar Grocy...",
+        "stock_stale": "⚠️ Grocy no responde: stock tal como estaba hace {age}.",
         "barcode_not_found": "Ningún producto coincide con",
+        "barcode_photo_none": "📷 No hay ningún código de barras legible en la foto. Prueba más cerca, plano y bien iluminado.",
+        "barcode_photo_unavailable": "📷 La lectura de fotos no está disponible (pyzbar/Pillow no instalados). Escribe el código de barras.",
         "product_updated": "✅ Producto actualizado con éxito en Grocy.",
+        "product_gone": "⚠️ Este producto ya no está en el stock de Grocy. Vuelve a buscar.",
+        "expiring_title": "⏳ Productos que caducan en {days} día(s):",
+        "expiring_none": "✅ Ningún producto caduca en {days} día(s).",
+        "expiring_usage": "Uso: /expiring [días]",
+        "import_usage": (
+            "Uso: /import seguido de una línea por producto (o, en privado, un archivo .csv "
+            "en respuesta a /import o con el texto /import):\n"
+            "código de barras o nombre ; cantidad\n"
+            "+3 añade, -2 consume, =5 fija la cantidad (3 solo = +3)."
+        ),
+        "import_running": "📦 Importando {n} producto(s)...",
+        "import_csv_hint": "📎 Archivo no importado: envíalo con el texto /import, o justo después de /import.",
+        "import_summary": "📦 Importación terminada: {ok} correcto(s), {failed} error(es), {skipped} línea(s) ignorada(s).",
+        "import_bad_line": "formato no válido",
+        "import_not_found": "producto no encontrado",
+        "import_ambiguous": "varios productos coinciden",
+        "import_failed": "error de Grocy",
+        "import_partial": "stock insuficiente, {done:g} de {asked:g} retirados",
+        "import_too_long": "⚠️ Demasiadas líneas: solo se procesan las {max} primeras.",
+        "plan_days": "¿Planificación para cuántos días? (1-{max})",
+        "plan_generation": "🤖 Generando {days} receta(s) en paralelo...",
+        "plan_day_title": "📅 Día {day}/{days}",
+        "plan_shopping_title": "🛒 Lista de la compra de la semana:",
+        "plan_shopping_none": "🛒 Nada que comprar para esta planificación.",
+        "product_update_queued": "⏳ Actualización enviada a Grocy...",
+        "product_update_failed": "❌ Error al actualizar Grocy para {name}.",
+        "product_consume_empty": "⚠️ {name}: no se ha retirado nada, el stock está vacío.",
+        "product_consume_partial": "⚠️ {name}: solo se retiraron {done:g}, el stock está vacío.",
         "product_to_list": "🛒 Producto (ficticio) agregado a la lista de compras.",
         "choose_quantity": "¿Qué cantidad deseas añadir o quitar?",
         "recipe_generation": "🤖 ¡Generando la receta ahora!",
+        "recipe_cached": "♻️ Receta ya generada para este stock. Usa « 🔄 Regénérer Recette » para obtener otra.",
+        "recipe_nothing_to_regenerate": "No hay receta para regenerar.",
+        "search_page_footer": "📄 {page}/{pages} ({n} resultados)",
+        "llm_queued": "⏳ Muchas solicitudes en curso: eres el n.º {pos} en la cola, tu receta llegará pronto.",
         "invalid_number": "Por favor, envía un número válido.",
         "invalid_choice": "Opción no válida. Reintenta o /start para cancelar.",
         # convives
@@ -125,17 +259,137 @@ TEXTS = {
 TELEGRAM_BOT_TOKEN = "TELEGRAM_BOT_TOKEN"
 GROCY_API_KEY = "GROCY_API_KEY"
 GROCY_BASE_URL = "http://xxx.xxx.xxx.xxx:9283"
+GROCY_TIMEOUT = 10             # secondes par appel
+GROCY_MAX_RETRIES = 2          # nouveaux essais après un échec réseau / 5xx (écritures : seulement si non envoyées)
+GROCY_RETRY_BACKOFF = 0.5      # délai initial (doublé à chaque essai)
+GROCY_MAX_CONCURRENCY = 4      # appels Grocy simultanés maximum
+GROCY_WATCH_INTERVAL = 5       # secondes entre deux lectures de db-changed-time (0 = désactivé)
+GROCY_WRITE_COALESCE_DELAY = 0.8  # fenêtre de regroupement des ajustements d'un même produit
+GROCY_WRITE_RETRIES = 4        # nouveaux essais d'une écriture en file avant abandon
 
 OPENAI_API_KEY = "OPENAI_API_KEY"
 OPENAI_MODEL = "gpt-4o"
-
-CONVIVES_CSV = "convives.csv"
+# Limites du compte OpenAI (requêtes et tokens par minute), tokens de réponse estimés par appel
+OPENAI_RPM = 60
+OPENAI_TPM = 90000
+OPENAI_EXPECTED_COMPLETION_TOKENS = 800
+OPENAI_MAX_RETRIES = 3
+
+CONVIVES_DB = "convives.db"
+CONVIVES_CSV = "convives.csv"   # ancien format, migré automatiquement vers CONVIVES_DB
+
+# Dernier stock valide sauvegardé sur disque : rechargé au démarrage et servi (avec son âge)
+# si Grocy ne répond pas dans STOCK_STALE_GRACE secondes
+STOCK_SNAPSHOT_FILE = "stock_snapshot.pickle"
+STOCK_STALE_GRACE = 3
+
+# Foyers : chaque foyer a sa propre instance Grocy et ses convives.
+# "default" reprend les clés ci-dessus ; CHAT_HOUSEHOLDS associe un chat/groupe à un foyer.
+HOUSEHOLDS = {
+    "default": {
+        "grocy_base_url": GROCY_BASE_URL,
+        "grocy_api_key": GROCY_API_KEY,
+        "convives_db": CONVIVES_DB,
+        "convives_csv": CONVIVES_CSV,
+        "stock_snapshot": STOCK_SNAPSHOT_FILE,
+    },
+    # "famille_martin": {
+    #     "grocy_base_url": "http://yyy.yyy.yyy.yyy:9283",
+    #     "grocy_api_key": "GROCY_API_KEY_MARTIN",
+    #     "convives_db": "convives_martin.db",
+    # },
+}
+CHAT_HOUSEHOLDS = {
+    # -1001234567890: "famille_martin",
+}
+MAX_ACTIVE_HOUSEHOLDS = 20       # foyers gardés ouverts en mémoire
+HOUSEHOLD_IDLE_TIMEOUT = 3600    # secondes d'inactivité avant fermeture d'un foyer
+MAX_CACHED_STOCK_ITEMS = 200000  # produits en cache, tous foyers confondus
+
+# Streaming de la recette : intervalle minimal entre deux éditions du message
+# (Telegram limite à ~1 édition/seconde par chat)
+STREAM_EDIT_INTERVAL = 1.5
+# Longueur max d'un message, en unités UTF-16 comme le compte Telegram (limite 4096)
+TELEGRAM_MAX_LEN = 4000
+
+# Envois Telegram : débit global (messages/s), intervalle minimal par chat privé / groupe,
+# essais sur RetryAfter
+TELEGRAM_GLOBAL_RATE = 25
+TELEGRAM_CHAT_INTERVAL = 1.0
+TELEGRAM_GROUP_INTERVAL = 3.0
+TELEGRAM_SEND_RETRIES = 3
+
+# Cache des recettes : nombre d'entrées (LRU) et fichier de persistance (None = mémoire seule)
+RECIPE_CACHE_SIZE = 100
+RECIPE_CACHE_FILE = "recettes_cache.json"
+
+# Photos produits : dossier du cache disque, taille max du cache, côté max des miniatures
+PICTURE_CACHE_DIR = "pictures_cache"
+PICTURE_CACHE_MAX_BYTES = 50* 1024* 1024
+PICTURE_THUMB_SIZE = 512
+PICTURE_PREFETCH_CONCURRENCY = 2
+
+# Budget de tokens du prompt recette (le stock est tronqué au-delà)
+PROMPT_TOKEN_BUDGET = 3000
+
+# Péremption : horizon "à risque" (jours) et nombre de produits signalés au modèle
+EXPIRY_RISK_DAYS = 7
+PROMPT_AT_RISK_ITEMS = 15
+
+# Planning semaine : jours max, appels OpenAI simultanés, produits à risque rappelés en consigne par jour
+PLAN_MAX_DAYS = 7
+OPENAI_PLAN_CONCURRENCY = 3
+PLAN_PRIORITY_ITEMS_PER_DAY = 3
+
+# Code-barres sur photo : processus de décodage, côté max de l'image décodée (px), délai max (s)
+BARCODE_SCAN_WORKERS = 2
+BARCODE_SCAN_MAX_SIDE = 1024
+BARCODE_SCAN_TIMEOUT = 5
+
+# /import : lignes max par import, écritures Grocy simultanées
+IMPORT_MAX_LINES = 500
+IMPORT_CONCURRENCY = 4
+IMPORT_PENDING_TIMEOUT = 600     # secondes pendant lesquelles un .csv répond à un /import sans liste
+
+# Exclusions alimentaires des convives : aussi rappelées au modèle dans le prompt
+PROMPT_INCLUDE_EXCLUSIONS = True
+EXCLUSION_MEMO_SIZE = 32
+
+# Recherche : nombre de résultats par page
+SEARCH_PAGE_SIZE = 10
+
+# Libellé affiché quand un produit n'a pas de code-barres
+NO_BARCODE = "Aucun code-barres"
+
+# Durée de vie (secondes) du cache partagé du stock Grocy
+STOCK_CACHE_TTL = 60
+
+# Mode webhook (alternative au polling) : actif si WEBHOOK_URL est renseignée
+WEBHOOK_URL = None               # ex: "https://bot.example.org/telegram"
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = None            # vérifié via l'en-tête X-Telegram-Bot-Api-Secret-Token (None = aléatoire à chaque démarrage)
+UPDATE_WORKERS = 8               # updates traitées en parallèle (jamais 2 du même chat)
+UPDATE_QUEUE_SIZE = 1000         # updates en attente max avant de refuser (Telegram renverra)
+UPDATE_ENQUEUE_TIMEOUT = 10      # secondes d'attente d'une place dans la file
+HTTP_MAX_BODY = 1024* 1024       # corps de requête max (octets) du serveur HTTP intégré, au-delà : 413
+HTTP_READ_TIMEOUT = 10           # secondes max pour recevoir en-têtes puis corps, au-delà : 408
+
+# État des conversations persisté sur disque (reprise après redémarrage)
+CONVERSATION_STATE_FILE = "conversations.pickle"
+
+# Métriques : endpoint Prometheus local (None = désactivé) et résumé périodique dans les logs (0 = désactivé)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+METRICS_LOG_INTERVAL = 0
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+logging.getLogger("httpx").setLevel(logging.WARNING)  # une ligne par requête sinon
 
 # -------------------------------------------------------------------
-# Définitions des états => range(10)
+# Définitions des états => range(11)
 # -------------------------------------------------------------------
 (
     MAIN_MENU,
@@ -147,146 +401,1800 @@ logger = logging.getLogger(__name__)
     GEN_RECETTE_NOTE,
     SEARCH_GROCY_RESULTS,
     SEARCH_GROCY_DETAIL,
-    SEARCH_GROCY_QUANTITY
-) = range(10)
-
-# -------------------------------------------------------------------
-# Fonctions CSV convives
-# -------------------------------------------------------------------
-def init_csv_file(file_path: str):
-    """Initialise le CSV si besoin."""
-    if not os.path.exists(file_path):
-        with open(file_path,'w', newline='', encoding='utf-8') as f:
-            w= csv.writer(f)
-            w.writerow(["name","aliments_non_supportes"])
-
-def read_convives(file_path: str):
-    conv=[]
-    if os.path.exists(file_path):
-        with open(file_path,'r', newline='', encoding='utf-8') as f:
-            r= csv.DictReader(f)
-            for row in r:
-                conv.append({
-                    "name": row["name"],
-                    "aliments_non_supportes": row["aliments_non_supportes"]
-                })
-    return conv
-
-def ajouter_convive(nom: str, file_path: str):
-    c= read_convives(file_path)
-    for x in c:
-        if x["name"].lower()== nom.lower():
-            return False, TEXTS[LANGUAGE]["convive_exists"].format(name=nom)
-    c.append({"name":nom,"aliments_non_supportes":""})
-    with open(file_path,'w', newline='', encoding='utf-8') as f:
-        w= csv.DictWriter(f, fieldnames=["name","aliments_non_supportes"])
-        w.writeheader()
-        for cc in c:
-            w.writerow(cc)
+    SEARCH_GROCY_QUANTITY,
+    PLAN_NB_JOURS
+) = range(11)
+
+# -------------------------------------------------------------------
+# Métriques (latences, erreurs, tailles) + endpoint Prometheus
+# -------------------------------------------------------------------
+LATENCY_BUCKETS= (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metrics:
+    """Histogrammes de latence, compteurs d'erreurs et tailles de charge utile, par opération."""
+    def __init__(self):
+        self._lat: Dict[str, List[int]]= {}        # op -> compte par bucket (+Inf en dernier)
+        self._lat_sum: Dict[str, float]= {}
+        self._lat_max: Dict[str, float]= {}
+        self._errors: Dict[str, int]= {}
+        self._size_sum: Dict[str, float]= {}
+        self._size_count: Dict[str, int]= {}
+        self._size_max: Dict[str, float]= {}
+        self._gauges: Dict[str, Callable[[], float]]= {}
+
+    def observe(self, op:str, seconds:float):
+        counts= self._lat.get(op)
+        if counts is None:
+            counts= self._lat[op]= [0]* (len(LATENCY_BUCKETS)+ 1)
+        i= 0
+        while i< len(LATENCY_BUCKETS) and seconds> LATENCY_BUCKETS[i]:
+            i+= 1
+        counts[i]+= 1
+        self._lat_sum[op]= self._lat_sum.get(op, 0.0)+ seconds
+        self._lat_max[op]= max(self._lat_max.get(op, 0.0), seconds)
+
+    def error(self, op:str):
+        self._errors[op]= self._errors.get(op, 0)+ 1
+
+    def size(self, op:str, value:float):
+        self._size_sum[op]= self._size_sum.get(op, 0.0)+ value
+        self._size_count[op]= self._size_count.get(op, 0)+ 1
+        self._size_max[op]= max(self._size_max.get(op, 0.0), value)
+
+    def gauge(self, name:str, fn:Callable[[], float]):
+        """Valeur lue au moment de l'export (ex: hits du cache)."""
+        self._gauges[name]= fn
+
+    def render_prometheus(self)->str:
+        out= [
+            "# HELP stocktoplate_latency_seconds Latence par opération.",
+            "# TYPE stocktoplate_latency_seconds histogram",
+        ]
+        for op, counts in sorted(self._lat.items()):
+            cum= 0
+            for le, c in zip(LATENCY_BUCKETS, counts):
+                cum+= c
+                out.append(f'stocktoplate_latency_seconds_bucket{{op="{op}",le="{le}"}} {cum}')
+            cum+= counts[-1]
+            out.append(f'stocktoplate_latency_seconds_bucket{{op="{op}",le="+Inf"}} {cum}')
+            out.append(f'stocktoplate_latency_seconds_sum{{op="{op}"}} {self._lat_sum[op]:.6f}')
+            out.append(f'stocktoplate_latency_seconds_count{{op="{op}"}} {cum}')
+        out+= [
+            "# HELP stocktoplate_errors_total Erreurs par opération.",
+            "# TYPE stocktoplate_errors_total counter",
+        ]
+        for op, n in sorted(self._errors.items()):
+            out.append(f'stocktoplate_errors_total{{op="{op}"}} {n}')
+        out+= [
+            "# HELP stocktoplate_payload_size Taille des données (produits, caractères, tokens).",
+            "# TYPE stocktoplate_payload_size summary",
+        ]
+        for op in sorted(self._size_count):
+            out.append(f'stocktoplate_payload_size_sum{{op="{op}"}} {self._size_sum[op]:g}')
+            out.append(f'stocktoplate_payload_size_count{{op="{op}"}} {self._size_count[op]}')
+        for name, fn in sorted(self._gauges.items()):
+            try:
+                val= float(fn())
+            except Exception:
+                continue
+            out.append(f"# TYPE stocktoplate_{name} gauge")
+            out.append(f"stocktoplate_{name} {val:g}")
+        return "\n".join(out)+ "\n"
+
+    def summary_lines(self)->List[str]:
+        lines= []
+        for op, counts in sorted(self._lat.items()):
+            n= sum(counts)
+            avg= self._lat_sum[op]/ n* 1000 if n else 0
+            line= (
+                f"{op}: {n} appels, {self._errors.get(op, 0)} erreurs, "
+                f"moy {avg:.0f} ms, max {self._lat_max[op]* 1000:.0f} ms"
+            )
+            if op in self._size_count:
+                line+= f", taille moy {self._size_sum[op]/ self._size_count[op]:.0f}"
+            lines.append(line)
+        return lines
+
+metrics= Metrics()
+
+def instrumented(op:Optional[str]= None, size:Optional[Callable]= None):
+    """
+    Décorateur : latence + erreurs (exceptions) de la fonction, coroutine ou
+    générateur asynchrone décoré. `size(result)` donne une taille de charge utile.
+    """
+    def deco(fn):
+        name= op or fn.__name__
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def agen(*args, **kwargs):
+                t0= time.perf_counter()
+                try:
+                    async for item in fn(*args, **kwargs):
+                        yield item
+                except Exception:
+                    metrics.error(name)
+                    raise
+                finally:
+                    metrics.observe(name, time.perf_counter()- t0)
+            return agen
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def coro(*args, **kwargs):
+                t0= time.perf_counter()
+                try:
+                    res= await fn(*args, **kwargs)
+                except Exception:
+                    metrics.error(name)
+                    raise
+                finally:
+                    metrics.observe(name, time.perf_counter()- t0)
+                if size is not None:
+                    metrics.size(name, size(res))
+                return res
+            return coro
+        @functools.wraps(fn)
+        def sync(*args, **kwargs):
+            t0= time.perf_counter()
+            try:
+                res= fn(*args, **kwargs)
+            except Exception:
+                metrics.error(name)
+                raise
+            finally:
+                metrics.observe(name, time.perf_counter()- t0)
+            if size is not None:
+                metrics.size(name, size(res))
+            return res
+        return sync
+    return deco
+
+HttpHandler= Callable[[str, str, Dict[str, str], bytes], Awaitable[Tuple[int, str, bytes]]]
+
+async def start_http_server(host:str, port:int, handler:HttpHandler)->asyncio.AbstractServer:
+    """
+    Mini serveur HTTP/1.1 (asyncio pur, sans dépendance) :
+    handler(méthode, chemin, en-têtes, corps) -> (statut, content-type, corps).
+    Exposé sur le réseau en mode webhook : lecture bornée dans le temps
+    (HTTP_READ_TIMEOUT) et en taille (HTTP_MAX_BODY, en-têtes 64 Ko).
+    """
+    async def on_conn(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head= await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HTTP_READ_TIMEOUT)
+            lines= head.decode("latin-1").split("\r\n")
+            method, path, _= lines[0].split(" ", 2)
+            headers= {}
+            for l in lines[1:]:
+                if ":" in l:
+                    k, v= l.split(":", 1)
+                    headers[k.strip().lower()]= v.strip()
+            body= b""
+            length= int(headers.get("content-length", 0) or 0)
+            if length< 0:
+                raise ValueError(length)
+            if length> HTTP_MAX_BODY:
+                status, ctype, payload= 413, "text/plain", b"payload too large"
+            else:
+                if length:
+                    body= await asyncio.wait_for(reader.readexactly(length), HTTP_READ_TIMEOUT)
+                status, ctype, payload= await handler(method, path, headers, body)
+        except asyncio.TimeoutError:
+            status, ctype, payload= 408, "text/plain", b"request timeout"
+        except asyncio.LimitOverrunError:
+            status, ctype, payload= 431, "text/plain", b"headers too large"
+        except (asyncio.IncompleteReadError, ValueError):
+            status, ctype, payload= 400, "text/plain", b"bad request"
+        except Exception as e:
+            logger.error(f"[HTTP] Erreur handler: {e}")
+            status, ctype, payload= 500, "text/plain", b"error"
+        try:
+            writer.write(
+                f"HTTP/1.1 {status} {'OK' if status< 400 else 'ERROR'}\r\n"
+                f"Content-Type: {ctype}\r\nContent-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1")+ payload
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+    return await asyncio.start_server(on_conn, host, port)
+
+async def metrics_http_handler(method:str, path:str, headers:Dict[str, str], body:bytes):
+    if method== "GET" and path.split("?")[0]== "/metrics":
+        return 200, "text/plain; version=0.0.4", metrics.render_prometheus().encode("utf-8")
+    return 404, "text/plain", b"not found"
+
+async def metrics_log_loop(interval:float):
+    """Résumé périodique des métriques dans les logs."""
+    while True:
+        await asyncio.sleep(interval)
+        for line in metrics.summary_lines():
+            logger.info(f"[Metrics] {line}")
+
+# -------------------------------------------------------------------
+# Convives (SQLite)
+# -------------------------------------------------------------------
+def normalize_term(text: str)->str:
+    """Minuscules, sans accents, espaces normalisés ("Crème  fraîche" -> "creme fraiche")."""
+    # Ligatures non décomposées par NFKD ("œufs" -> "oeufs")
+    decomposed= unicodedata.normalize("NFKD", text.lower().replace("œ", "oe").replace("æ", "ae"))
+    return " ".join("".join(c for c in decomposed if not unicodedata.combining(c)).split())
+
+def parse_exclusions(aliments: str)->List[str]:
+    """Texte libre "gluten, lactose / fruits à coque" -> termes normalisés, sans doublons."""
+    terms= []
+    for part in re.split(r"[,;/\n]+", aliments or ""):
+        t= normalize_term(part)
+        if t and t not in terms:
+            terms.append(t)
+    return terms
+
+class ConvivesStore:
+    """
+    Stockage des convives dans SQLite :
+    - index sur le nom en minuscules (clé primaire) ;
+    - mises à jour atomiques ligne par ligne (une transaction par opération) ;
+    - cache mémoire de la liste, invalidé à chaque écriture ;
+    - exclusions normalisées (colonne `exclusions`, un terme par ligne)
+      tenues à jour avec aliments_non_supportes.
+    """
+    SCHEMA_VERSION= 2
+
+    def __init__(self, db_path: str):
+        self.db_path= db_path
+        self._lock= threading.Lock()
+        self._cache: Optional[List[Dict[str, str]]]= None
+        self._conn= sqlite3.connect(db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS convives ("
+                " name_key TEXT PRIMARY KEY,"
+                " name TEXT NOT NULL,"
+                " aliments_non_supportes TEXT NOT NULL DEFAULT '',"
+                " exclusions TEXT NOT NULL DEFAULT '')"
+            )
+        self._migrate()
+
+    def _migrate(self):
+        """v1 -> v2 : ajout de la colonne exclusions, remplie depuis aliments_non_supportes."""
+        version= self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version>= self.SCHEMA_VERSION:
+            return
+        cols= {r[1] for r in self._conn.execute("PRAGMA table_info(convives)")}
+        with self._conn:
+            if "exclusions" not in cols:
+                self._conn.execute("ALTER TABLE convives ADD COLUMN exclusions TEXT NOT NULL DEFAULT ''")
+            rows= self._conn.execute("SELECT name_key, aliments_non_supportes FROM convives").fetchall()
+            self._conn.executemany(
+                "UPDATE convives SET exclusions=? WHERE name_key=?",
+                [("\n".join(parse_exclusions(a)), k) for k, a in rows]
+            )
+            self._conn.execute(f"PRAGMA user_version={self.SCHEMA_VERSION}")
+        logger.info(f"[Convives] Base migrée en v{self.SCHEMA_VERSION} ({len(rows)} convive(s))")
+
+    def migrate_csv(self, csv_path: str):
+        """Import unique de l'ancien CSV (name, aliments_non_supportes), renommé ensuite en .migrated."""
+        if not os.path.exists(csv_path):
+            return
+        with open(csv_path,'r', newline='', encoding='utf-8') as f:
+            rows= [
+                (r["name"].lower(), r["name"], r.get("aliments_non_supportes") or "",
+                 "\n".join(parse_exclusions(r.get("aliments_non_supportes") or "")))
+                for r in csv.DictReader(f) if r.get("name")
+            ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO convives(name_key, name, aliments_non_supportes, exclusions)"
+                " VALUES (?,?,?,?)",
+                rows
+            )
+            self._cache= None
+        os.replace(csv_path, csv_path+ ".migrated")
+        logger.info(f"[Convives] {len(rows)} convive(s) migré(s) depuis {csv_path}")
+
+    def all(self)->List[Dict[str, str]]:
+        with self._lock:
+            if self._cache is None:
+                cur= self._conn.execute(
+                    "SELECT name, aliments_non_supportes, exclusions FROM convives ORDER BY rowid"
+                )
+                self._cache= [
+                    {"name": n, "aliments_non_supportes": a, "exclusions": tuple(e.split("\n")) if e else ()}
+                    for n, a, e in cur.fetchall()
+                ]
+            # Copie : l'appelant peut modifier sa liste sans toucher au cache
+            return [dict(c) for c in self._cache]
+
+    def _write(self, sql: str, params: tuple)->bool:
+        with self._lock, self._conn:
+            changed= self._conn.execute(sql, params).rowcount> 0
+            if changed:
+                self._cache= None
+            return changed
+
+    def add(self, nom: str)->bool:
+        return self._write(
+            "INSERT OR IGNORE INTO convives(name_key, name) VALUES (?,?)",
+            (nom.lower(), nom)
+        )
+
+    def remove(self, nom: str)->bool:
+        return self._write("DELETE FROM convives WHERE name_key=?", (nom.lower(),))
+
+    def set_aliments(self, nom: str, aliments: str)->bool:
+        return self._write(
+            "UPDATE convives SET aliments_non_supportes=?, exclusions=? WHERE name_key=?",
+            (aliments, "\n".join(parse_exclusions(aliments)), nom.lower())
+        )
+
+    def close(self):
+        self._conn.close()
+
+def init_convives_store(db_path: str, csv_path: str)->ConvivesStore:
+    """Ouvre la base des convives et migre l'ancien CSV s'il existe encore."""
+    store= ConvivesStore(db_path)
+    if csv_path:
+        store.migrate_csv(csv_path)
+    return store
+
+def read_convives(store: ConvivesStore):
+    return store.all()
+
+def ajouter_convive(nom: str, store: ConvivesStore):
+    if not store.add(nom):
+        return False, TEXTS[LANGUAGE]["convive_exists"].format(name=nom)
     return True, TEXTS[LANGUAGE]["convive_added"].format(name=nom)
 
-def supprimer_convive(nom:str, file_path:str):
-    c= read_convives(file_path)
-    newc= [xx for xx in c if xx["name"].lower()!= nom.lower()]
-    if len(newc)== len(c):
+def supprimer_convive(nom:str, store: ConvivesStore):
+    if not store.remove(nom):
         return False, TEXTS[LANGUAGE]["convive_notfound"].format(name=nom)
-    with open(file_path,'w', newline='', encoding='utf-8') as f:
-        w= csv.DictWriter(f, fieldnames=["name","aliments_non_supportes"])
-        w.writeheader()
-        for cc in newc:
-            w.writerow(cc)
     return True, TEXTS[LANGUAGE]["convive_removed"].format(name=nom)
 
-def modifier_aliments_convive(nom:str, aliments:str, file_path:str):
-    c= read_convives(file_path)
-    found= False
-    for cc in c:
-        if cc["name"].lower()== nom.lower():
-            cc["aliments_non_supportes"]= aliments
-            found= True
-            break
-    if not found:
+def modifier_aliments_convive(nom:str, aliments:str, store: ConvivesStore):
+    if not store.set_aliments(nom, aliments):
         return False, TEXTS[LANGUAGE]["convive_notfound"].format(name=nom)
-    with open(file_path,'w', newline='', encoding='utf-8') as f:
-        w= csv.DictWriter(f, fieldnames=["name","aliments_non_supportes"])
-        w.writeheader()
-        for x in c:
-            w.writerow(x)
     return True, TEXTS[LANGUAGE]["convive_modified"].format(name=nom)
 
 # -------------------------------------------------------------------
 # Grocy
 # -------------------------------------------------------------------
-def get_grocy_stock():
+class GrocyClient:
+    """
+    Client HTTP asynchrone pour Grocy :
+    - une session httpx partagée (keep-alive, pool de connexions) ;
+    - timeout par appel ;
+    - retry avec backoff exponentiel sur erreurs réseau / 5xx / 429 ;
+      les écritures (non idempotentes) ne sont retentées que si la requête
+      n'a jamais atteint Grocy (connexion refusée, pool saturé, 429) ;
+    - nombre d'appels simultanés borné par un sémaphore.
+    """
+    RETRY_STATUS= {429, 500, 502, 503, 504}
+    # Erreurs où la requête n'a pas été envoyée : la renvoyer est sans risque
+    NOT_SENT_ERRORS= (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+    @classmethod
+    def never_sent(cls, e: Exception)->bool:
+        """True si la requête en échec n'a certainement pas été traitée par Grocy."""
+        if isinstance(e, httpx.HTTPStatusError):
+            return e.response.status_code== 429
+        return isinstance(e, cls.NOT_SENT_ERRORS)
+
+    def __init__(self, base_url: str, api_key: str, timeout: float= 10.0,
+                 max_retries: int= 3, backoff: float= 0.5, max_concurrency: int= 4):
+        self.base_url= base_url.rstrip("/")
+        self.api_key= api_key
+        self.timeout= timeout
+        self.max_retries= max_retries
+        self.backoff= backoff
+        self.max_concurrency= max_concurrency
+        self._client: Optional[httpx.AsyncClient]= None
+        self._sem: Optional[asyncio.Semaphore]= None
+        self.closed= False
+
+    def _session(self)->httpx.AsyncClient:
+        # Après aclose() (foyer fermé), pas de nouveau pool créé en douce
+        if self.closed:
+            raise RuntimeError(f"GrocyClient fermé ({self.base_url})")
+        # Création paresseuse : le client doit vivre dans la boucle asyncio du bot
+        if self._client is None or self._client.is_closed:
+            self._client= httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"GROCY-API-KEY": self.api_key, "Accept": "application/json"},
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency
+                )
+            )
+            self._sem= asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def request(self, method: str, path: str, timeout: Optional[float]= None,
+                      idempotent: Optional[bool]= None, **kwargs)->httpx.Response:
+        """
+        Requête avec retry/backoff. Lève httpx.HTTPError si tous les essais échouent.
+        idempotent (par défaut : GET/HEAD) autorise le retry des échecs ambigus
+        (timeout de lecture, 5xx) ; sinon seuls les échecs never_sent() sont retentés.
+        """
+        if idempotent is None:
+            idempotent= method.upper() in ("GET", "HEAD")
+        client= self._session()
+        last_exc: Optional[Exception]= None
+        for attempt in range(self.max_retries+ 1):
+            try:
+                async with self._sem:
+                    r= await client.request(method, path, timeout=timeout or self.timeout, **kwargs)
+                if r.status_code in self.RETRY_STATUS and attempt< self.max_retries:
+                    last_exc= httpx.HTTPStatusError(
+                        f"HTTP {r.status_code}", request=r.request, response=r
+                    )
+                else:
+                    r.raise_for_status()
+                    return r
+            except (httpx.TransportError, httpx.TimeoutException) as e:
+                last_exc= e
+            if not idempotent and not self.never_sent(last_exc):
+                raise last_exc
+            if attempt< self.max_retries:
+                delay= self.backoff* (2** attempt)
+                logger.warning(f"[Grocy] {method} {path} échec ({last_exc}), nouvel essai dans {delay:.1f}s")
+                await asyncio.sleep(delay)
+        raise last_exc
+
+    async def get_json(self, path: str, timeout: Optional[float]= None):
+        r= await self.request("GET", path, timeout=timeout)
+        return r.json()
+
+    async def post_json(self, path: str, payload: dict, timeout: Optional[float]= None,
+                        idempotent: bool= False):
+        r= await self.request("POST", path, timeout=timeout, idempotent=idempotent, json=payload)
+        return r.json() if r.content else None
+
+    async def aclose(self):
+        self.closed= True
+        if self._client is not None:
+            await self._client.aclose()
+            self._client= None
+
+def grocy_picture_url(prod: dict)->Optional[str]:
+    """URL (relative à GROCY_BASE_URL) de la photo d'un produit, si elle existe."""
+    if prod.get("picture_url"):
+        return prod["picture_url"]
+    fname= prod.get("picture_file_name")
+    if not fname:
+        return None
+    b64= base64.b64encode(fname.encode("utf-8")).decode("ascii")
+    return f"/api/files/productpictures/{b64}"
+
+NO_BARCODES= (NO_BARCODE,)              # sentinelle partagée par tous les produits sans code-barres
+NO_BARCODES_LOWER= (NO_BARCODE.lower(),)
+
+class StockItem:
+    """
+    Produit du stock, en mémoire compacte : attributs fixes (__slots__),
+    chaînes répétitives internées, code-barres en tuple (sentinelle partagée
+    si aucun), nom/code-barres en minuscules, nom normalisé (exclusions) et
+    date de péremption calculés une seule fois (recherche, index et prompt
+    n'ont plus à le refaire).
+    """
+    __slots__= ("product_id", "product_name", "amount", "best_before_date", "barcodes",
+                "picture_url", "name_lower", "name_norm", "barcodes_lower", "best_before")
+
+    def __init__(self, product_id, product_name:str, amount, best_before_date:str,
+                 barcodes:tuple, picture_url:Optional[str]):
+        self.product_id= product_id
+        self.product_name= sys.intern(product_name)
+        self.amount= amount
+        self.best_before_date= sys.intern(best_before_date)
+        if barcodes:
+            self.barcodes= tuple(sys.intern(b) for b in barcodes)
+            self.barcodes_lower= tuple(b.lower() for b in self.barcodes)
+        else:
+            self.barcodes= NO_BARCODES
+            self.barcodes_lower= NO_BARCODES_LOWER
+        self.picture_url= picture_url
+        self.name_lower= product_name.lower()
+        self.name_norm= normalize_term(product_name)
+        self.best_before= parse_best_before(best_before_date)
+
+    def to_row(self)->tuple:
+        """Champs source seuls (snapshot disque) ; from_row() recalcule le reste."""
+        barcodes= () if self.barcodes is NO_BARCODES else self.barcodes
+        return (self.product_id, self.product_name, self.amount, self.best_before_date,
+                barcodes, self.picture_url)
+
+    @classmethod
+    def from_row(cls, row:tuple)->"StockItem":
+        return cls(*row)
+
+    def __repr__(self):
+        return f"StockItem({self.product_id!r}, {self.product_name!r}, {self.amount!r})"
+
+def parse_grocy_stock(data: list)->List[StockItem]:
+    """Convertit la réponse brute de GET /stock en liste de produits."""
+    results=[]
+    for item in data:
+        prod= item.get("product", {})
+        results.append(StockItem(
+            item.get("product_id",""),
+            prod.get("name","Inconnu"),
+            item.get("amount",0),
+            str(item.get("best_before_date","N/A")),
+            prod.get("barcodes") or (),
+            grocy_picture_url(prod)
+        ))
+    return results
+
+@instrumented(size=len)
+async def get_grocy_stock(client: GrocyClient):
     """Appel GET /stock pour récupérer tout le stock, code-barres inclus."""
-    url= f"{GROCY_BASE_URL}/api/stock"
-    headers= {
-        "GROCY-API-KEY": GROCY_API_KEY,
-        "Accept":"application/json"
-    }
     try:
-        r= requests.get(url, headers=headers, timeout=10)
-        r.raise_for_status()
-        data= r.json()
-        results=[]
-        for item in data:
-            prod= item.get("product", {})
-            barcodes= prod.get("barcodes", [])
-            if not barcodes:
-                barcodes= ["Aucun code-barres"]
-            results.append({
-                "product_id": item.get("product_id",""),
-                "product_name": prod.get("name","Inconnu"),
-                "amount": item.get("amount",0),
-                "best_before_date": item.get("best_before_date","N/A"),
-                "barcodes": barcodes,
-                "picture_url": prod.get("picture_url", None)
-            })
-        return results
+        data= await client.get_json("/api/stock")
+        return parse_grocy_stock(data)
     except Exception as e:
+        metrics.error("get_grocy_stock")
         logger.error(f"Erreur get_grocy_stock: {e}")
         return []
 
-def update_grocy_product(product_id:str, new_amount:float):
+@instrumented()
+async def update_grocy_product(client: GrocyClient, product_id:str, new_amount:float)->bool:
     """Appel POST /stock/products/{product_id}/inventory pour mettre à jour la quantité."""
-    url= f"{GROCY_BASE_URL}/api/stock/products/{product_id}/inventory"
-    headers= {
-        "GROCY-API-KEY": GROCY_API_KEY,
-        "Accept":"application/json",
-        "Content-Type":"application/json"
-    }
     payload= {"new_amount": new_amount}
     try:
-        resp= requests.post(url, json=payload, headers=headers, timeout=10)
-        resp.raise_for_status()
+        # Quantité absolue : renvoyer la même requête est sans effet de bord
+        await client.post_json(f"/api/stock/products/{product_id}/inventory", payload, idempotent=True)
         logger.info(f"[Grocy] Update product {product_id} => {new_amount}")
-    except requests.HTTPError as e:
+        return True
+    except httpx.HTTPError as e:
         logger.error(f"HTTPError update_grocy_product: {e}")
     except Exception as ex:
         logger.error(f"Erreur inattendue update_grocy_product: {ex}")
+    metrics.error("update_grocy_product")
+    return False
+
+@instrumented()
+async def adjust_grocy_product(client: GrocyClient, product_id:str, delta:float):
+    """
+    Ajustement RELATIF via POST /stock/products/{id}/add ou /consume :
+    deux modifications concurrentes s'additionnent au lieu de s'écraser.
+    Lève httpx.HTTPError en cas d'échec.
+    """
+    if delta> 0:
+        await client.post_json(f"/api/stock/products/{product_id}/add", {"amount": delta})
+    elif delta< 0:
+        await client.post_json(f"/api/stock/products/{product_id}/consume", {"amount": -delta})
+    logger.info(f"[Grocy] Ajustement produit {product_id} => {delta:+g}")
+
+async def get_grocy_product_amount(client: GrocyClient, product_id:str)->float:
+    """Quantité en stock d'un produit (GET /stock/products/{id})."""
+    data= await client.get_json(f"/api/stock/products/{product_id}")
+    return float(data.get("stock_amount") or 0)
+
+async def apply_grocy_delta(client: GrocyClient, product_id:str, delta:float,
+                            max_retries:int, backoff:float)->Optional[float]:
+    """
+    Ajustement relatif sans double application. add/consume n'étant pas
+    idempotents, un échec ambigu (timeout de lecture, 5xx : Grocy a peut-être
+    appliqué la requête) n'est renvoyé qu'après relecture de la quantité :
+    - quantité avant + delta => déjà appliqué, succès ;
+    - quantité inchangée => pas appliqué, nouvel essai ;
+    - autre valeur (modification concurrente) => échec, sans renvoi.
+    La quantité consommée n'est pas bornée par un stock en cache : si Grocy
+    refuse (400, stock insuffisant), la quantité réelle est relue et seule
+    celle-ci est consommée.
+    Renvoie la variation réellement appliquée (0 si rien à consommer), None en échec.
+    """
+    if delta== 0:
+        return 0.0
+    before: Optional[float]= None
+    err: Optional[Exception]= None
+    attempt= 0
+    while attempt<= max_retries:
+        try:
+            if before is None:
+                before= await get_grocy_product_amount(client, product_id)
+            await adjust_grocy_product(client, product_id, delta)
+            return delta
+        except httpx.HTTPStatusError as e:
+            status= e.response.status_code
+            if status== 400 and delta< 0:
+                # Consommer plus que le stock : on consomme ce qu'il reste vraiment
+                try:
+                    before= await get_grocy_product_amount(client, product_id)
+                except Exception as e2:
+                    logger.error(f"[Grocy] Consommation refusée produit {product_id}, relecture impossible: {e2}")
+                    return None
+                if before< -delta:
+                    logger.info(f"[Grocy] Produit {product_id} : {-delta:g} demandé(s), {before:g} en stock")
+                    if before<= 0:
+                        return 0.0
+                    delta= -before
+                    continue  # nouvel envoi immédiat, pas compté comme un échec
+            # Erreur client : inutile de réessayer
+            if status< 500 and status!= 429:
+                logger.error(f"[Grocy] Écriture refusée produit {product_id} ({delta:+g}): {e}")
+                return None
+            err= e
+        except Exception as e:
+            err= e
+        if before is not None and not GrocyClient.never_sent(err):
+            try:
+                after= await get_grocy_product_amount(client, product_id)
+            except Exception as e:
+                logger.error(f"[Grocy] Écriture incertaine produit {product_id} ({delta:+g}), relecture impossible: {e}")
+                return None
+            if abs(after- (before+ delta))< 1e-6:
+                logger.info(f"[Grocy] Écriture produit {product_id} appliquée malgré l'erreur ({err})")
+                return delta
+            if abs(after- before)>= 1e-6:
+                logger.error(f"[Grocy] Écriture incertaine produit {product_id} ({delta:+g}): "
+                             f"quantité {before:g} -> {after:g}, pas de renvoi")
+                return None
+        if attempt< max_retries:
+            wait= backoff* (2** attempt)
+            logger.warning(f"[Grocy] Écriture produit {product_id} échouée ({err}), nouvel essai dans {wait:.1f}s")
+            await asyncio.sleep(wait)
+        attempt+= 1
+    logger.error(f"[Grocy] Écriture abandonnée produit {product_id} ({delta:+g})")
+    return None
 
 # -------------------------------------------------------------------
-# openai
+# File d'écriture Grocy (write-behind, regroupement par produit)
 # -------------------------------------------------------------------
-def call_openai_chatgpt(stock_data:list, convives:list, note:str, nb_convives:int)->str:
-    """Construit le prompt avec TOUT le stock (incluant code-barres) et envoie à gpt-4o."""
-    openai.api_key= OPENAI_API_KEY
+class GrocyWriteQueue:
+    """
+    Les ajustements d'un même produit arrivant dans une fenêtre de `delay`
+    secondes sont additionnés en UN seul appel add/consume.
+    Les écritures d'un même produit sont sérialisées ; un échec temporaire
+    est retenté avec backoff, sans double application (apply_grocy_delta).
+    submit() renvoie un Future résolu, une fois l'écriture confirmée par Grocy,
+    en (variation demandée, variation appliquée ou None si échec) pour le lot.
+    """
+    def __init__(self, client: GrocyClient, cache: "StockCache", delay:float, max_retries:int, backoff:float= 1.0):
+        self.client= client
+        self.cache= cache
+        self.delay= delay
+        self.max_retries= max_retries
+        self.backoff= backoff
+        self._pending: Dict[str, dict]= {}        # produit -> {"delta", "waiters"}
+        self._locks: Dict[str, asyncio.Lock]= {}
+        self._tasks: Set[asyncio.Task]= set()
+
+    def submit(self, product_id:str, delta:float)->asyncio.Future:
+        pid= str(product_id)
+        fut= asyncio.get_running_loop().create_future()
+        entry= self._pending.get(pid)
+        if entry is None:
+            entry= {"delta": 0.0, "waiters": []}
+            self._pending[pid]= entry
+            task= asyncio.create_task(self._flush_later(pid))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        entry["delta"]+= delta
+        entry["waiters"].append(fut)
+        return fut
+
+    async def _flush_later(self, pid:str):
+        await asyncio.sleep(self.delay)
+        lock= self._locks.setdefault(pid, asyncio.Lock())
+        async with lock:
+            # Les ajustements arrivés pendant l'attente du verrou partent aussi
+            entry= self._pending.pop(pid)
+            applied= await self._write(pid, entry["delta"])
+        for fut in entry["waiters"]:
+            if not fut.done():
+                fut.set_result((entry["delta"], applied))
+
+    async def _write(self, pid:str, delta:float)->Optional[float]:
+        if delta== 0:
+            return 0.0
+        applied= await apply_grocy_delta(self.client, pid, delta, self.max_retries, self.backoff)
+        # Invalidation même en échec : une écriture incertaine a pu modifier le stock
+        self.cache.invalidate()
+        return applied
+
+    def busy(self)->bool:
+        return bool(self._tasks)
+
+    async def flush(self):
+        """Attend la fin de toutes les écritures en file (arrêt du bot)."""
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
 
-    lines= ""
-    for p in stock_data:
-        bc_join= ", ".join(p["barcodes"])
-        lines+= (
-            f"- {p['product_name']} (Qté:{p['amount']}, Péremption:{p['best_before_date']}, "
-            f"Code-barres:{bc_join})\n"
+# -------------------------------------------------------------------
+# Cache stock Grocy (partagé par tous les chats d'un foyer)
+# -------------------------------------------------------------------
+STOCK_SNAPSHOT_FORMAT= 2   # lignes StockItem.to_row()
+
+def format_age(seconds:float)->str:
+    """Durée lisible : 45 s, 12 min, 3 h, 2 j."""
+    if seconds< 60:
+        return f"{int(seconds)} s"
+    if seconds< 3600:
+        return f"{int(seconds// 60)} min"
+    if seconds< 86400:
+        return f"{int(seconds// 3600)} h"
+    return f"{int(seconds// 86400)} j"
+
+class StockCache:
+    """
+    Cache en mémoire du stock Grocy avec TTL.
+    - Single-flight : les appels concurrents partagent UNE seule requête en cours.
+    - invalidate() après une écriture dans Grocy.
+    - Compteurs hits/misses pour régler le TTL.
+    - Stale-while-revalidate : le dernier stock valide (sauvegardé sur disque si
+      snapshot_path) est servi si Grocy ne répond pas dans stale_grace secondes ;
+      le rechargement continue en arrière-plan.
+    """
+    def __init__(self, ttl: float, fetch: Callable[[], Awaitable[list]],
+                 snapshot_path: Optional[str]= None, stale_grace: float= STOCK_STALE_GRACE):
+        self.ttl= ttl
+        self.fetch= fetch
+        self.snapshot_path= snapshot_path
+        self.stale_grace= stale_grace
+        self.hits= 0
+        self.misses= 0
+        self.stale_served= 0
+        self._data: Optional[list]= None
+        self._fetched_at= float("-inf")
+        self._data_time= 0.0              # horodatage (time.time) du stock en mémoire
+        self._serving_stale= False
+        self._version= 0          # incrémenté à chaque invalidation
+        self._inflight: Optional[asyncio.Task]= None
+        self._inflight_version= 0   # version au lancement de la requête en vol
+        self._loads: Set[asyncio.Task]= set()   # requêtes non terminées (y compris dépassées)
+        self._listeners: List[Callable[[list], None]]= []
+        self._save_lock= threading.Lock()
+
+    def add_listener(self, cb: Callable[[list], None]):
+        """Enregistre un callback appelé à chaque nouveau snapshot (ex: index de recherche)."""
+        self._listeners.append(cb)
+
+    def is_fresh(self)->bool:
+        return self._data is not None and (time.monotonic()- self._fetched_at) < self.ttl
+
+    def invalidate(self):
+        """
+        Marque le cache comme périmé (une requête en cours ne sera pas mise en cache).
+        Le stock reste disponible comme secours si Grocy ne répond pas.
+        """
+        self._version+= 1
+        self._fetched_at= float("-inf")
+
+    def clear(self):
+        """Libère le stock en mémoire (rechargé au prochain accès)."""
+        self.invalidate()
+        self._data= None
+
+    def touch(self):
+        """Prolonge la fraîcheur du snapshot (Grocy confirme qu'il n'a pas changé)."""
+        if self._data is not None:
+            self._fetched_at= time.monotonic()
+
+    def stale_age(self)->Optional[float]:
+        """Âge (secondes) du stock servi faute de réponse de Grocy ; None s'il est à jour."""
+        if not self._serving_stale or self._data is None:
+            return None
+        return max(0.0, time.time()- self._data_time)
+
+    def load_snapshot(self)->bool:
+        """Charge le dernier stock sauvegardé (périmé : rechargé au premier accès)."""
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                snap= pickle.load(f)
+        except Exception as e:
+            logger.warning(f"[Stock] Snapshot illisible {self.snapshot_path}: {e}")
+            return False
+        if snap.get("format")!= STOCK_SNAPSHOT_FORMAT:
+            logger.info(f"[Stock] Snapshot d'un ancien format ignoré: {self.snapshot_path}")
+            return False
+        stock= [StockItem.from_row(r) for r in snap["rows"]]
+        self._set_data(stock, snap["saved_at"], fresh=False)
+        logger.info(
+            f"[Stock] Snapshot chargé: {len(stock)} produits "
+            f"(il y a {format_age(time.time()- snap['saved_at'])})"
         )
-    c_str= ", ".join(convives) if convives else "Aucun"
+        return True
+
+    def _save_snapshot(self, data:list, saved_at:float):
+        """(Thread) Écriture atomique : fichier temporaire puis os.replace."""
+        with self._save_lock:
+            tmp= self.snapshot_path+ ".tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    rows= [p.to_row() for p in data]
+                    snap= {"format": STOCK_SNAPSHOT_FORMAT, "saved_at": saved_at, "rows": rows}
+                    pickle.dump(snap, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, self.snapshot_path)
+            except Exception as e:
+                logger.warning(f"[Stock] Sauvegarde du snapshot impossible: {e}")
+
+    def _set_data(self, data:list, data_time:float, fresh:bool):
+        self._data= data
+        self._data_time= data_time
+        self._fetched_at= time.monotonic() if fresh else float("-inf")
+        self._serving_stale= not fresh
+        for cb in self._listeners:
+            try:
+                cb(data)
+            except Exception as ex:
+                logger.error(f"Erreur listener stock: {ex}")
+
+    async def _load(self, version:int)->list:
+        try:
+            data= await self.fetch()
+            # On ne garde que les résultats non vides et non invalidés pendant la requête
+            if data and version== self._version:
+                now= time.time()
+                self._set_data(data, now, fresh=True)
+                if self.snapshot_path:
+                    asyncio.get_running_loop().run_in_executor(None, self._save_snapshot, data, now)
+            return data
+        finally:
+            # Une requête dépassée par une invalidation ne libère pas la suivante
+            if self._inflight is asyncio.current_task():
+                self._inflight= None
+
+    async def close(self):
+        """Annule les chargements en cours (foyer fermé)."""
+        tasks= list(self._loads)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _start_load(self)->asyncio.Task:
+        # Une requête lancée avant la dernière invalidation peut renvoyer un stock
+        # antérieur à l'écriture : on ne la rejoint pas, on en lance une nouvelle
+        if self._inflight is None or self._inflight_version!= self._version:
+            self.misses+= 1
+            task= asyncio.get_running_loop().create_task(self._load(self._version))
+            self._loads.add(task)
+            task.add_done_callback(self._loads.discard)
+            # Erreur consommée ici si plus personne n'attend (stock périmé déjà servi)
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight= task
+            self._inflight_version= self._version
+        else:
+            # Une requête est déjà en vol : on l'attend au lieu d'en relancer une
+            self.hits+= 1
+        return self._inflight
+
+    async def refresh(self)->list:
+        """Force un rechargement immédiat (attend la réponse de Grocy, sans secours)."""
+        self.invalidate()
+        return await asyncio.shield(self._start_load())
+
+    async def get(self)->list:
+        """
+        Renvoie le stock, depuis le cache si frais, sinon via un seul appel Grocy partagé ;
+        si Grocy échoue ou dépasse stale_grace, renvoie le dernier stock valide.
+        """
+        if self.is_fresh():
+            self.hits+= 1
+            return self._data
+        task= self._start_load()
+        if self._data is None:
+            return await asyncio.shield(task)
+        try:
+            data= await asyncio.wait_for(asyncio.shield(task), self.stale_grace)
+        except Exception as e:
+            if not isinstance(e, asyncio.TimeoutError):
+                logger.warning(f"[Stock] Grocy indisponible: {e}")
+            data= None
+        if data:
+            return data
+        self.stale_served+= 1
+        self._serving_stale= True
+        return self._data
+
+    def stats(self)->Dict[str, float]:
+        total= self.hits+ self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits/ total, 3) if total else 0.0,
+            "ttl": self.ttl,
+            "items": len(self._data) if self._data else 0,
+            "stale_served": self.stale_served,
+        }
 
-    prompt= f"""
+
+# -------------------------------------------------------------------
+# Détection de changements Grocy (db-changed-time)
+# -------------------------------------------------------------------
+class GrocyChangeWatcher:
+    """
+    Tâche de fond qui lit GET /system/db-changed-time (réponse de quelques octets)
+    toutes les `interval` secondes. Le stock complet n'est retéléchargé (et
+    ré-indexé via les listeners du cache) que si l'horodatage a bougé ;
+    sinon le snapshot courant est simplement prolongé.
+    """
+    def __init__(self, client: GrocyClient, cache: StockCache, interval: float):
+        self.client= client
+        self.cache= cache
+        self.interval= interval
+        self.last_changed: Optional[str]= None
+        self._task: Optional[asyncio.Task]= None
+
+    def start(self):
+        if self.interval> 0 and self._task is None:
+            self._task= asyncio.create_task(self._run())
+
+    async def stop(self):
+        task= self._task
+        if task is not None:
+            self._task= None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def pause(self):
+        """Arrête la surveillance sans attendre (stock libéré) ; start() la relance."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task= None
+        self.last_changed= None
+
+    async def check(self)->bool:
+        """Renvoie True si le stock a été rechargé."""
+        data= await self.client.get_json("/api/system/db-changed-time", timeout=5)
+        changed= data.get("changed_time")
+        if changed== self.last_changed and self.cache.is_fresh():
+            self.cache.touch()
+            return False
+        stock= await self.cache.refresh()
+        if stock:
+            self.last_changed= changed
+            logger.info(f"[Watcher] Grocy modifié ({changed}), stock rechargé: {len(stock)} produits")
+        return True
+
+    async def _run(self):
+        # Sortie aussi si l'annulation est avalée par le transport HTTP
+        while self._task is asyncio.current_task():
+            try:
+                await self.check()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"[Watcher] db-changed-time indisponible: {e}")
+            await asyncio.sleep(self.interval)
+
+
+# -------------------------------------------------------------------
+# Index de recherche (construit une fois par snapshot du stock)
+# -------------------------------------------------------------------
+class StockSearchIndex:
+    """
+    Index inversé sur le stock :
+    - table de hachage exacte code-barres -> produits ;
+    - table de hachage exacte nom normalisé (normalize_term) -> produits ;
+    - n-grammes (1 à 3 caractères) sur le nom ET les code-barres, pour la
+      recherche multi-mots (ET logique) de match_all_words.
+    Les candidats issus des n-grammes sont vérifiés par sous-chaîne, donc
+    les résultats sont identiques à un parcours complet avec match_all_words.
+    Mise à jour incrémentale : seuls les produits ajoutés/modifiés/supprimés
+    sont ré-indexés.
+    """
+    NGRAM= 3
+
+    def __init__(self):
+        self._snapshot: Optional[list]= None
+        self._items: Dict[str, StockItem]= {}     # clé produit -> produit
+        self._sig: Dict[str, tuple]= {}           # clé produit -> (nom, code-barres)
+        self._fields: Dict[str, List[str]]= {}    # clé produit -> champs en minuscules
+        self._order: Dict[str, int]= {}           # clé produit -> position dans le stock
+        self._grams: Dict[str, Set[str]]= {}      # n-gramme -> clés produits
+        self._barcodes: Dict[str, Set[str]]= {}   # code-barres exact -> clés produits
+        self._names: Dict[str, Set[str]]= {}      # nom normalisé -> clés produits
+        self._norm: Dict[str, str]= {}            # clé produit -> nom normalisé
+
+    @staticmethod
+    def _key(p: StockItem, pos: int)->str:
+        pid= p.product_id
+        return str(pid) if pid not in (None, "") else f"#{pos}"
+
+    @classmethod
+    def _grams_of(cls, text: str)->Set[str]:
+        g= set()
+        for n in range(1, cls.NGRAM+ 1):
+            for i in range(len(text)- n+ 1):
+                g.add(text[i:i+n])
+        return g
+
+    def _add(self, key: str, p: StockItem):
+        fields= [p.name_lower, *p.barcodes_lower]
+        self._fields[key]= fields
+        self._sig[key]= (p.product_name, p.barcodes)
+        for f in fields:
+            for g in self._grams_of(f):
+                self._grams.setdefault(g, set()).add(key)
+        if p.barcodes is not NO_BARCODES:
+            for b in p.barcodes_lower:
+                self._barcodes.setdefault(b, set()).add(key)
+        self._norm[key]= p.name_norm
+        self._names.setdefault(p.name_norm, set()).add(key)
+
+    def _remove(self, key: str):
+        norm= self._norm.pop(key, None)
+        if norm is not None:
+            s= self._names.get(norm)
+            if s is not None:
+                s.discard(key)
+                if not s:
+                    del self._names[norm]
+        for f in self._fields.pop(key, []):
+            for g in self._grams_of(f):
+                s= self._grams.get(g)
+                if s is not None:
+                    s.discard(key)
+                    if not s:
+                        del self._grams[g]
+            s= self._barcodes.get(f)
+            if s is not None:
+                s.discard(key)
+                if not s:
+                    del self._barcodes[f]
+        self._sig.pop(key, None)
+
+    def ensure(self, stock: list):
+        """Synchronise l'index avec ce snapshot (no-op si déjà fait)."""
+        if stock is self._snapshot:
+            return
+        t0= time.perf_counter()
+        new_items: Dict[str, StockItem]= {}
+        order: Dict[str, int]= {}
+        for pos, p in enumerate(stock):
+            k= self._key(p, pos)
+            new_items[k]= p
+            order[k]= pos
+        changed= 0
+        for k in [k for k in self._items if k not in new_items]:
+            self._remove(k)
+            changed+= 1
+        for k, p in new_items.items():
+            sig= (p.product_name, p.barcodes)
+            if self._sig.get(k)!= sig:
+                self._remove(k)
+                self._add(k, p)
+                changed+= 1
+        self._items= new_items
+        self._order= order
+        self._snapshot= stock
+        logger.info(
+            f"[Index] {len(new_items)} produits, {changed} ré-indexés "
+            f"en {(time.perf_counter()- t0)*1000:.1f} ms"
+        )
+
+    def _candidates(self, word: str)->Set[str]:
+        if len(word)<= self.NGRAM:
+            return self._grams.get(word, set())
+        # Intersection des trigrammes du mot (du plus rare au plus fréquent)
+        posting= sorted(
+            (self._grams.get(word[i:i+self.NGRAM], set()) for i in range(len(word)- self.NGRAM+ 1)),
+            key=len
+        )
+        cand= set(posting[0])
+        for s in posting[1:]:
+            cand&= s
+            if not cand:
+                break
+        return cand
+
+    def search(self, query_words: list)->list:
+        """Même règle que match_all_words : chaque mot dans le nom OU un code-barres."""
+        return [self._items[k] for k in self._search_keys(query_words)]
+
+    def _search_keys(self, query_words: list)->List[str]:
+        if not query_words:
+            return sorted(self._items, key=self._order.get)
+        cand: Optional[Set[str]]= None
+        for w in sorted(query_words, key=len, reverse=True):
+            c= self._candidates(w)
+            cand= set(c) if cand is None else cand & c
+            if not cand:
+                return []
+        # Les mots courts (<= NGRAM) sont déjà exacts via leur n-gramme : seuls les longs sont vérifiés
+        longs= [w for w in query_words if len(w)> self.NGRAM]
+        found= [
+            k for k in cand
+            if all(any(w in f for f in self._fields[k]) for w in longs)
+        ]
+        found.sort(key=self._order.get)
+        return found
+
+    def ranked_search(self, query: str)->List[str]:
+        """
+        Identifiants des produits trouvés, classés par pertinence :
+        0) code-barres exact, 1) nom commençant par la requête, 2) sous-chaîne.
+        L'ordre du stock départage les ex-aequo.
+        """
+        q= query.strip().lower()
+        words= q.split()
+        exact= self._barcodes.get(q, set())
+        def rank(k: str)->tuple:
+            if k in exact:
+                r= 0
+            elif self._fields[k][0].startswith(q) or (words and self._fields[k][0].startswith(words[0])):
+                r= 1
+            else:
+                r= 2
+            return (r, self._order[k])
+        keys= self._search_keys(words)
+        keys.sort(key=rank)
+        return keys
+
+    def get(self, product_id)->Optional[StockItem]:
+        """Produit du dernier snapshot indexé, par identifiant."""
+        return self._items.get(str(product_id))
+
+    def lookup_barcode(self, code: str)->list:
+        """Recherche exacte (O(1)) par code-barres."""
+        keys= self._barcodes.get(code.strip().lower(), set())
+        return [self._items[k] for k in sorted(keys, key=self._order.get)]
+
+    def lookup_name(self, name: str)->list:
+        """Recherche exacte (O(1)) par nom, à la casse et aux accents près."""
+        keys= self._names.get(normalize_term(name), set())
+        return [self._items[k] for k in sorted(keys, key=self._order.get)]
+
+
+# -------------------------------------------------------------------
+# Exclusions alimentaires des convives (filtrage du stock avant le prompt)
+# -------------------------------------------------------------------
+def guests_exclusions(convives: List[dict])->List[str]:
+    """Union des exclusions des convives, dans l'ordre d'apparition."""
+    terms= []
+    for c in convives:
+        for t in c.get("exclusions", ()):
+            if t not in terms:
+                terms.append(t)
+    return terms
+
+class ExclusionFilter:
+    """
+    Stock sans les produits qu'un des convives ne mange pas : un terme exclu
+    doit apparaître comme mot entier (pluriel s/x toléré) dans le nom normalisé
+    ("lait" exclut "Lait entier" mais pas "Laitue", ni "Pâtes sans gluten"
+    pour "gluten"). Résultat mémorisé par
+    (convives, exclusions, snapshot du stock) : une nouvelle combinaison ou un
+    nouveau stock seulement déclenche un parcours.
+    """
+    def __init__(self, max_entries: int):
+        self.max_entries= max_entries
+        self._memo: "OrderedDict[tuple, tuple]"= OrderedDict()
+
+    @staticmethod
+    def _pattern(terms: List[str]):
+        alts= "|".join(re.escape(t) for t in sorted(terms, key=len, reverse=True))
+        return re.compile(rf"(?<!sans )(?<!without )(?<!sin )\b(?:{alts})(?:s|x|es)?\b")
+
+    def filter(self, stock: list, convives: List[dict])->list:
+        terms= guests_exclusions(convives)
+        if not terms or not stock:
+            return stock
+        key= (frozenset(c["name"].lower() for c in convives), frozenset(terms), id(stock))
+        memo= self._memo.get(key)
+        if memo is not None and memo[0] is stock:
+            self._memo.move_to_end(key)
+            return memo[1]
+        pat= self._pattern(terms)
+        kept= [p for p in stock if not pat.search(p.name_norm)]
+        self._memo[key]= (stock, kept)
+        while len(self._memo)> self.max_entries:
+            self._memo.popitem(last=False)
+        logger.info(f"[Exclusions] {len(stock)}-> {len(kept)} produits ({', '.join(terms)})")
+        return kept
+
+    def clear(self):
+        self._memo.clear()
+
+# -------------------------------------------------------------------
+# Lecture de code-barres sur photo (décodage dans un pool de processus)
+# -------------------------------------------------------------------
+try:
+    from PIL import Image  # optionnel : miniatures locales et lecture des photos
+except ImportError:
+    Image= None
+
+try:
+    from pyzbar.pyzbar import decode as zbar_decode, ZBarSymbol  # optionnel : code-barres sur photo
+except ImportError:  # module absent ou bibliothèque zbar introuvable
+    zbar_decode= None
+
+def decode_barcodes(data:bytes, max_side:int)->List[str]:
+    """
+    (Exécuté dans un processus de travail) Réduit l'image à max_side puis
+    décode les EAN/UPC. Renvoie les codes lus, sans doublons.
+    """
+    img= Image.open(io.BytesIO(data))
+    # JPEG : réduction directe au décodage (bien plus rapide que de tout décoder)
+    img.draft("L", (max_side, max_side))
+    img= img.convert("L")
+    img.thumbnail((max_side, max_side))
+    symbols= [ZBarSymbol.EAN13, ZBarSymbol.EAN8, ZBarSymbol.UPCA, ZBarSymbol.UPCE]
+    codes= []
+    for r in zbar_decode(img, symbols=symbols):
+        code= r.data.decode("ascii", "ignore").strip()
+        if code and code not in codes:
+            codes.append(code)
+    return codes
+
+def barcode_variants(code:str)->List[str]:
+    """Un UPC-A (12 chiffres) peut être lu ou saisi en EAN-13 (0 en tête), et inversement."""
+    if len(code)== 13 and code.startswith("0"):
+        return [code, code[1:]]
+    if len(code)== 12:
+        return [code, "0"+ code]
+    return [code]
+
+class BarcodeScanner:
+    """
+    Pool de processus borné pour le décodage (CPU) : la boucle asyncio n'est
+    jamais bloquée et au plus `workers` images sont décodées à la fois, les
+    suivantes attendent leur tour.
+    """
+    def __init__(self, workers:int, max_side:int, timeout:float):
+        self.workers= workers
+        self.max_side= max_side
+        self.timeout= timeout
+        self._pool: Optional[ProcessPoolExecutor]= None
+        self._sem: Optional[asyncio.Semaphore]= None
+
+    @staticmethod
+    def available()->bool:
+        return zbar_decode is not None and Image is not None
+
+    def start(self):
+        """Crée le pool (spawn : pas de fork d'un processus multi-thread) et le préchauffe."""
+        if self._pool is None and self.available():
+            self._pool= ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            for _ in range(self.workers):
+                self._pool.submit(int)
+
+    @instrumented("barcode_scan")
+    async def scan(self, data:bytes)->List[str]:
+        self.start()
+        if self._sem is None:
+            self._sem= asyncio.Semaphore(self.workers)
+        async with self._sem:
+            loop= asyncio.get_running_loop()
+            fut= loop.run_in_executor(self._pool, decode_barcodes, data, self.max_side)
+            return await asyncio.wait_for(fut, self.timeout)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool= None
+
+barcode_scanner= BarcodeScanner(BARCODE_SCAN_WORKERS, BARCODE_SCAN_MAX_SIDE, BARCODE_SCAN_TIMEOUT)
+
+# -------------------------------------------------------------------
+# Index de péremption (construit une fois par snapshot du stock)
+# -------------------------------------------------------------------
+NEVER_EXPIRES= date(2999, 12, 31)   # valeur Grocy pour "ne périme jamais"
+
+def parse_best_before(value)->Optional[date]:
+    """Date de péremption Grocy -> date (None si absente, illisible ou "jamais")."""
+    text= str(value)[:10]
+    try:
+        d= date.fromisoformat(text)  # format Grocy, bien plus rapide que strptime
+    except ValueError:
+        try:
+            d= datetime.strptime(text, "%Y-%m-%d").date()
+        except ValueError:
+            return None
+    return None if d>= NEVER_EXPIRES else d
+
+class ExpiryIndex:
+    """
+    Produits datés triés par date de péremption (tableau trié + bisect).
+    Les jours restants sont calculés à la lecture, l'index reste donc valable
+    d'un jour à l'autre ; seul un nouveau snapshot le reconstruit.
+    """
+    def __init__(self):
+        self._snapshot: Optional[list]= None
+        self._dates: List[date]= []
+        self._items: list= []
+        self._ranked: list= []
+
+    def ensure(self, stock: list):
+        """Reconstruit l'index pour ce snapshot (no-op si déjà fait)."""
+        if stock is self._snapshot:
+            return
+        dated= []
+        undated= []
+        for pos, p in enumerate(stock):
+            d= p.best_before
+            if d is None:
+                undated.append(p)
+            else:
+                dated.append((d, pos, p))
+        dated.sort(key=lambda t: (t[0], t[1]))
+        self._dates= [t[0] for t in dated]
+        self._items= [t[2] for t in dated]
+        self._ranked= self._items+ undated
+        self._snapshot= stock
+
+    def ranked(self, stock: list)->list:
+        """Stock du plus proche de la péremption au plus lointain (sans date à la fin)."""
+        if stock is self._snapshot:
+            return self._ranked
+        # Liste hors snapshot (rare) : tri ponctuel
+        return rank_by_expiry(stock)
+
+    def expiring(self, days: int, today: Optional[date]= None)->List[tuple]:
+        """(produit, jours restants) pour les produits périmant d'ici `days` jours (périmés inclus)."""
+        today= today or date.today()
+        end= bisect_right(self._dates, today+ timedelta(days=days))
+        return [(self._items[i], (self._dates[i]- today).days) for i in range(end)]
+
+
+# -------------------------------------------------------------------
+# Photos produits (préchargement, miniatures, cache disque, file_id Telegram)
+# -------------------------------------------------------------------
+class ProductPictureCache:
+    """
+    - Préchargement en tâche de fond des photos Grocy (concurrence bornée).
+    - Miniatures bornées à PICTURE_THUMB_SIZE (redimensionnement côté Grocy via
+      best_fit_*, puis localement avec Pillow si disponible).
+    - Cache disque limité en taille (éviction des fichiers les moins récemment
+      utilisés), suivi en mémoire : pas de parcours du répertoire par téléchargement.
+    - Une photo n'est préchargée qu'une fois (même évincée ensuite, elle n'est
+      retéléchargée qu'à l'affichage) et jamais une fois le cache plein.
+    - Mémorise le file_id Telegram après le premier envoi : les affichages
+      suivants se font par référence, sans ré-upload.
+    """
+    def __init__(self, client: GrocyClient, cache_dir:str, max_bytes:int, thumb_size:int, concurrency:int):
+        self.client= client
+        self.cache_dir= cache_dir
+        self.max_bytes= max_bytes
+        self.thumb_size= thumb_size
+        self.concurrency= concurrency
+        self._file_ids: Dict[str, str]= {}
+        self._ids_path= os.path.join(cache_dir, "file_ids.json")
+        self._prefetch_task: Optional[asyncio.Task]= None
+        self._fetching: Dict[str, asyncio.Future]= {}
+        self._files: "OrderedDict[str, int]"= OrderedDict()   # chemin -> taille, du moins au plus récemment utilisé
+        self._total= 0
+        self.evictions= 0
+        self._seen: Set[str]= set()        # URLs déjà téléchargées ou tentées : pas de nouveau préchargement
+
+    def load(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        files= []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".jpg"):
+                p= os.path.join(self.cache_dir, name)
+                st= os.stat(p)
+                files.append((st.st_mtime, p, st.st_size))
+        for _, p, size in sorted(files):
+            self._files[p]= size
+            self._total+= size
+        if os.path.exists(self._ids_path):
+            try:
+                with open(self._ids_path,'r', encoding='utf-8') as f:
+                    self._file_ids= json.load(f)
+            except Exception as e:
+                logger.error(f"Erreur lecture file_ids photos: {e}")
+
+    def _save_ids(self):
+        tmp= self._ids_path+ ".tmp"
+        try:
+            with open(tmp,'w', encoding='utf-8') as f:
+                json.dump(self._file_ids, f)
+            os.replace(tmp, self._ids_path)
+        except Exception as e:
+            logger.error(f"Erreur écriture file_ids photos: {e}")
+
+    def _path(self, url:str)->str:
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode("utf-8")).hexdigest()+ ".jpg")
+
+    def file_id(self, url:str)->Optional[str]:
+        return self._file_ids.get(url)
+
+    def remember(self, url:str, file_id:str):
+        if self._file_ids.get(url)!= file_id:
+            self._file_ids[url]= file_id
+            self._save_ids()
+
+    def forget(self, url:str):
+        if self._file_ids.pop(url, None) is not None:
+            self._save_ids()
+
+    def _thumbnail(self, data:bytes)->bytes:
+        if Image is None:
+            return data
+        img= Image.open(io.BytesIO(data))
+        img.thumbnail((self.thumb_size, self.thumb_size))
+        out= io.BytesIO()
+        img.convert("RGB").save(out, format="JPEG", quality=85)
+        return out.getvalue()
+
+    def _store(self, path:str, raw:bytes)->int:
+        """Miniature écrite sur disque (thread) ; renvoie sa taille."""
+        data= self._thumbnail(raw)
+        tmp= path+ ".tmp"
+        with open(tmp,'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return len(data)
+
+    def full(self)->bool:
+        """Cache à sa taille max (une éviction a déjà eu lieu) : plus de préchargement."""
+        return self.evictions> 0 or self._total>= self.max_bytes
+
+    async def _download(self, url:str)->Optional[str]:
+        path= self._path(url)
+        r= await self.client.request("GET", url, params={
+            "force_serve_as": "picture",
+            "best_fit_width": self.thumb_size,
+            "best_fit_height": self.thumb_size,
+        })
+        size= await asyncio.to_thread(self._store, path, r.content)
+        self._total+= size- self._files.pop(path, 0)
+        self._files[path]= size
+        self._evict(keep=path)
+        return path
+
+    async def get_path(self, url:str)->Optional[str]:
+        """Chemin local de la miniature (téléchargée si besoin, un seul téléchargement par URL)."""
+        path= self._path(url)
+        self._seen.add(url)
+        if path in self._files:
+            self._files.move_to_end(path)  # LRU : dernière utilisation
+            try:
+                os.utime(path)  # ordre conservé au redémarrage
+                return path
+            except OSError:
+                self._total-= self._files.pop(path)
+        fut= self._fetching.get(url)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        fut= asyncio.get_running_loop().create_future()
+        self._fetching[url]= fut
+        res= None
+        try:
+            res= await self._download(url)
+        except Exception as e:
+            logger.warning(f"[Photos] Téléchargement impossible {url}: {e}")
+        finally:
+            # Même si ce téléchargement est annulé : les autres attentes sur
+            # cette URL reçoivent None au lieu de rester bloquées
+            self._fetching.pop(url, None)
+            if not fut.done():
+                fut.set_result(res)
+        return res
+
+    def _evict(self, keep:Optional[str]= None):
+        """Supprime les miniatures les moins récemment utilisées au-delà de max_bytes."""
+        for p in list(self._files):
+            if self._total<= self.max_bytes:
+                break
+            if p== keep:
+                continue
+            self._total-= self._files.pop(p)
+            self.evictions+= 1
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def schedule_prefetch(self, stock:list):
+        """Listener du cache stock : précharge en fond les photos jamais téléchargées."""
+        try:
+            loop= asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self.full() or (self._prefetch_task and not self._prefetch_task.done()):
+            return
+        urls= [
+            p.picture_url for p in stock
+            if p.picture_url and p.picture_url not in self._seen
+            and p.picture_url not in self._file_ids
+            and self._path(p.picture_url) not in self._files
+        ]
+        if urls:
+            self._prefetch_task= loop.create_task(self._prefetch(urls))
+
+    async def close(self):
+        """Annule le préchargement en cours (foyer fermé)."""
+        task= self._prefetch_task
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            self._prefetch_task= None
+
+    async def _prefetch(self, urls:list):
+        sem= asyncio.Semaphore(self.concurrency)
+        done= [0]
+        async def one(u):
+            async with sem:
+                # Cache plein : la suite ne se télécharge qu'à l'affichage
+                if self.full():
+                    return
+                await self.get_path(u)
+                done[0]+= 1
+        await asyncio.gather(*(one(u) for u in urls))
+        logger.info(f"[Photos] {done[0]}/{len(urls)} photo(s) préchargée(s)")
+
+# -------------------------------------------------------------------
+# Foyers : une instance Grocy (et ses caches) par chat / groupe
+# -------------------------------------------------------------------
+class Household:
+    """
+    Tout ce qui dépend d'une instance Grocy : pool de connexions, cache et
+    index du stock, file d'écriture, surveillance, photos et convives.
+    """
+    def __init__(self, name:str, conf:dict):
+        self.name= name
+        self.last_used= time.monotonic()
+        self.in_use= 0            # handlers en cours (household_of) : jamais fermé tant que > 0
+        self.client= GrocyClient(
+            conf["grocy_base_url"], conf["grocy_api_key"],
+            timeout=GROCY_TIMEOUT,
+            max_retries=GROCY_MAX_RETRIES,
+            backoff=GROCY_RETRY_BACKOFF,
+            max_concurrency=GROCY_MAX_CONCURRENCY
+        )
+        self.stock_cache= StockCache(
+            STOCK_CACHE_TTL, lambda: get_grocy_stock(self.client),
+            snapshot_path=conf.get("stock_snapshot", f"stock_snapshot_{name}.pickle")
+        )
+        self.stock_index= StockSearchIndex()
+        self.expiry_index= ExpiryIndex()
+        self.exclusions= ExclusionFilter(EXCLUSION_MEMO_SIZE)
+        self.writes= GrocyWriteQueue(self.client, self.stock_cache, GROCY_WRITE_COALESCE_DELAY, GROCY_WRITE_RETRIES)
+        self.watcher= GrocyChangeWatcher(self.client, self.stock_cache, GROCY_WATCH_INTERVAL)
+        self.pictures= ProductPictureCache(
+            self.client, os.path.join(PICTURE_CACHE_DIR, name),
+            PICTURE_CACHE_MAX_BYTES, PICTURE_THUMB_SIZE, PICTURE_PREFETCH_CONCURRENCY
+        )
+        # Via self : drop_stock() peut remplacer les index sans réenregistrer
+        self.stock_cache.add_listener(lambda stock: self.stock_index.ensure(stock))
+        self.stock_cache.add_listener(lambda stock: self.expiry_index.ensure(stock))
+        self.stock_cache.add_listener(self.pictures.schedule_prefetch)
+        self.convives= init_convives_store(conf["convives_db"], conf.get("convives_csv", ""))
+        self.pictures.load()
+        # Démarrage sans attendre Grocy : dernier stock connu, rechargé en arrière-plan
+        self.stock_cache.load_snapshot()
+
+    def start(self):
+        """Tâches de fond (nécessite la boucle asyncio)."""
+        self.watcher.start()
+
+    async def get_stock(self)->list:
+        """Snapshot du stock, indexé."""
+        self.last_used= time.monotonic()
+        # Surveillance suspendue par drop_stock() : relancée au premier accès
+        self.watcher.start()
+        stock= await self.stock_cache.get()
+        if stock:
+            self.stock_index.ensure(stock)
+        return stock
+
+    async def resolve_product(self, product_id)->Optional[StockItem]:
+        """Retrouve un produit par identifiant dans le snapshot partagé (état conversation compact)."""
+        if product_id is None:
+            return None
+        await self.get_stock()
+        return self.stock_index.get(product_id)
+
+    def cached_items(self)->int:
+        return self.stock_cache.stats()["items"]
+
+    def drop_stock(self):
+        """
+        Libère la mémoire du stock (rechargé au prochain accès). La surveillance
+        est suspendue, sinon son prochain passage rechargerait tout le stock.
+        """
+        self.watcher.pause()
+        self.stock_cache.clear()
+        self.stock_index= StockSearchIndex()
+        self.expiry_index= ExpiryIndex()
+        self.exclusions.clear()
+
+    async def close(self):
+        await self.watcher.stop()
+        await self.pictures.close()
+        await self.stock_cache.close()
+        await self.writes.flush()
+        await self.client.aclose()
+        self.convives.close()
+
+class HouseholdRegistry:
+    """
+    chat_id -> foyer (CHAT_HOUSEHOLDS, sinon "default").
+    Les foyers sont ouverts à la demande ; au-delà de MAX_ACTIVE_HOUSEHOLDS ou
+    après HOUSEHOLD_IDLE_TIMEOUT sans activité, les moins récemment utilisés
+    sont fermés, sauf s'ils servent encore un handler (in_use). Si le total de produits en cache dépasse MAX_CACHED_STOCK_ITEMS,
+    le stock des foyers inactifs est libéré.
+    """
+    def __init__(self, households:Dict[str, dict], chat_map:Dict[int, str]):
+        self.configs= households
+        self.chat_map= chat_map
+        self._active: "OrderedDict[str, Household]"= OrderedDict()
+        self._closing: Set[asyncio.Task]= set()
+
+    def name_for(self, chat_id)->str:
+        return self.chat_map.get(chat_id, "default")
+
+    def get(self, chat_id)->Household:
+        name= self.name_for(chat_id)
+        hh= self._active.get(name)
+        if hh is None:
+            hh= Household(name, self.configs[name])
+            self._active[name]= hh
+            try:
+                asyncio.get_running_loop()
+                hh.start()
+            except RuntimeError:
+                pass
+            logger.info(f"[Foyers] Ouverture du foyer '{name}' ({len(self._active)} actifs)")
+        self._active.move_to_end(name)
+        hh.last_used= time.monotonic()
+        self._evict(keep=name)
+        return hh
+
+    def active(self)->List[Household]:
+        return list(self._active.values())
+
+    def _evict(self, keep:str):
+        now= time.monotonic()
+        for name, hh in list(self._active.items()):
+            if name== keep or hh.in_use or hh.writes.busy():
+                continue
+            idle= now- hh.last_used> HOUSEHOLD_IDLE_TIMEOUT
+            if idle or len(self._active)> MAX_ACTIVE_HOUSEHOLDS:
+                self._close(name)
+        total= sum(hh.cached_items() for hh in self._active.values())
+        for name, hh in list(self._active.items()):
+            if total<= MAX_CACHED_STOCK_ITEMS:
+                break
+            if name!= keep and not hh.in_use and hh.cached_items():
+                total-= hh.cached_items()
+                hh.drop_stock()
+                logger.info(f"[Foyers] Stock du foyer '{name}' libéré (limite mémoire)")
+
+    def _close(self, name:str):
+        hh= self._active.pop(name)
+        logger.info(f"[Foyers] Fermeture du foyer inactif '{name}'")
+        task= asyncio.get_running_loop().create_task(hh.close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def close_all(self):
+        for name in list(self._active):
+            self._close(name)
+        if self._closing:
+            await asyncio.gather(*list(self._closing), return_exceptions=True)
+
+households= HouseholdRegistry(HOUSEHOLDS, CHAT_HOUSEHOLDS)
+
+# Foyers utilisés par le handler en cours (voir holds_household)
+_household_leases: contextvars.ContextVar[Optional[List[Household]]]= contextvars.ContextVar(
+    "household_leases", default=None
+)
+
+def household_of(update: Update)->Household:
+    """Foyer du chat de l'update, réservé jusqu'à la fin du handler (holds_household)."""
+    chat= update.effective_chat
+    hh= households.get(chat.id if chat is not None else None)
+    leases= _household_leases.get()
+    if leases is not None and hh not in leases:
+        hh.in_use+= 1
+        leases.append(hh)
+    return hh
+
+def holds_household(fn):
+    """
+    Décorateur de handler : les foyers obtenus par household_of() pendant
+    le handler ne peuvent pas être fermés par l'éviction avant sa fin.
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        token= _household_leases.set([])
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            for hh in _household_leases.get():
+                hh.in_use-= 1
+            _household_leases.reset(token)
+    return wrapper
+
+# -------------------------------------------------------------------
+# openai
+# -------------------------------------------------------------------
+try:
+    import tiktoken  # optionnel : comptage exact des tokens
+except ImportError:
+    tiktoken= None
+
+_token_encoder= None
+
+def count_tokens(text:str)->int:
+    """Nombre de tokens (tiktoken si installé, sinon estimation ~4 caractères/token)."""
+    global _token_encoder
+    if tiktoken is not None:
+        if _token_encoder is None:
+            try:
+                _token_encoder= tiktoken.encoding_for_model(OPENAI_MODEL)
+            except KeyError:
+                _token_encoder= tiktoken.get_encoding("cl100k_base")
+        return len(_token_encoder.encode(text))
+    return (len(text)+ 3)// 4
+
+def rank_by_expiry(stock_data:list, expiry:Optional[ExpiryIndex]= None)->list:
+    """Stock classé par péremption la plus proche (ordre précalculé par l'index du foyer si fourni)."""
+    if expiry is not None:
+        return expiry.ranked(stock_data)
+    return sorted(stock_data, key=lambda p: p.best_before or date.max)
+
+class PromptStats:
+    """Tokens envoyés par requête, pour suivre coût et latence quand le stock grossit."""
+    def __init__(self):
+        self.requests= 0
+        self.total_tokens= 0
+        self.last_tokens= 0
+        self.last_items= 0
+
+    def record(self, tokens:int, items:int):
+        self.requests+= 1
+        self.total_tokens+= tokens
+        self.last_tokens= tokens
+        self.last_items= items
+
+    def stats(self)->Dict[str, float]:
+        return {
+            "requests": self.requests,
+            "last_tokens": self.last_tokens,
+            "last_items": self.last_items,
+            "avg_tokens": round(self.total_tokens/ self.requests) if self.requests else 0,
+        }
+
+prompt_stats= PromptStats()
+
+@instrumented(size=len)
+def build_recipe_prompt(stock_data:list, convives:list, note:str, nb_convives:int,
+                        token_budget:int= PROMPT_TOKEN_BUDGET,
+                        expiry:Optional[ExpiryIndex]= None,
+                        exclusions:Optional[List[str]]= None,
+                        ranked:bool= False)->str:
+    """
+    Construit le prompt dans la limite de token_budget :
+    - seuls nom, quantité et péremption sont envoyés (pas les code-barres) ;
+    - les produits sont classés par péremption la plus proche (ranked=True :
+      stock_data est déjà dans cet ordre, ex. ExpiryIndex.ranked() filtré) ;
+    - la liste est tronquée quand le budget est atteint.
+    """
+    head= recipe_prompt_head(convives, nb_convives)
+    tail= recipe_prompt_tail(note, exclusions_line(exclusions))
+    lines, used= budget_stock_lines(stock_data, count_tokens(head)+ count_tokens(tail), token_budget, expiry, ranked)
+    prompt_stats.record(used, len(lines))
+    metrics.size("prompt_tokens", used)
+    logger.info(
+        f"[Prompt] {used} tokens (budget {token_budget}), "
+        f"{len(lines)}/{len(stock_data)} produits envoyés"
+    )
+    return head+ "".join(line for _, line, _ in lines)+ tail
+
+def recipe_prompt_head(convives:list, nb_convives:int)->str:
+    c_str= ", ".join(convives) if convives else "Aucun"
+    return f"""
 Je veux une recette pour {nb_convives} convive(s) : {c_str}.
 
-Voici tout le stock de produits (priorité à ceux qui périment vite), incluant code-barres :
-{lines}
+Voici le stock de produits, du plus proche de la péremption au plus lointain (priorité à ceux qui périment vite) :
+"""
 
+def exclusions_line(exclusions:Optional[List[str]])->str:
+    if not exclusions:
+        return ""
+    return f"\nAliments que les convives ne mangent pas (à exclure) : {', '.join(exclusions)}.\n"
+
+def recipe_prompt_tail(note:str, extra:str= "")->str:
+    return f"""{extra}
 Note spéciale : {note}.
 
 Exigences:
@@ -297,46 +2205,663 @@ Exigences:
 5) Explique clairement les étapes.
 6) Mentionne explicitement le nom du produit si présent en stock.
 """
-    try:
-        rep= openai.ChatCompletion.create(
-            model=OPENAI_MODEL,
-            messages=[{"role":"user","content":prompt}],
-            temperature=0.7
+
+def budget_stock_lines(stock_data:list, used:int, token_budget:int,
+                       expiry:Optional[ExpiryIndex]= None, ranked:bool= False)->Tuple[List[tuple], int]:
+    """
+    Lignes (produit, texte, tokens) du stock classé par péremption, tant que le
+    budget n'est pas atteint ; renvoie aussi le total de tokens utilisés.
+    ranked=True : stock_data est déjà classé, aucun tri.
+    """
+    ranked= stock_data if ranked else rank_by_expiry(stock_data, expiry)
+    limit= date.today()+ timedelta(days=EXPIRY_RISK_DAYS)
+    lines= []
+    for i, p in enumerate(ranked):
+        # Les N premiers produits à risque (en tête du classement) sont signalés au modèle
+        d= p.best_before if i< PROMPT_AT_RISK_ITEMS else None
+        flag= " ⚠️ à utiliser en priorité" if d is not None and d<= limit else ""
+        line= f"- {p.product_name} (Qté:{p.amount}, Péremption:{p.best_before_date}){flag}\n"
+        cost= count_tokens(line)
+        if used+ cost> token_budget:
+            break
+        lines.append((p, line, cost))
+        used+= cost
+    return lines, used
+
+PLAN_SHOPPING_PREFIX= "ACHATS:"
+
+@instrumented(size=len)
+def build_plan_prompts(stock_data:list, convives:list, note:str, nb_convives:int, days:int,
+                       token_budget:int= PROMPT_TOKEN_BUDGET,
+                       expiry:Optional[ExpiryIndex]= None,
+                       exclusions:Optional[List[str]]= None,
+                       ranked:bool= False)->List[str]:
+    """
+    Un prompt par jour du planning. Le contexte (convives, lignes de stock et
+    leur coût en tokens) est construit une seule fois. TOUS les produits
+    signalés « à utiliser en priorité » sont répartis à tour de rôle entre les
+    jours : chacun n'apparaît que dans le prompt du jour auquel il est réservé
+    (les PLAN_PRIORITY_ITEMS_PER_DAY premiers sont aussi rappelés en consigne).
+    """
+    head= recipe_prompt_head(convives, nb_convives)
+    base_tail= recipe_prompt_tail(note, exclusions_line(exclusions))
+    # Marge pour les consignes propres à chaque jour
+    reserve= count_tokens(base_tail)+ 40* (PLAN_PRIORITY_ITEMS_PER_DAY+ 2)
+    lines, shared= budget_stock_lines(stock_data, count_tokens(head)+ reserve, token_budget, expiry, ranked)
+
+    # Mêmes produits que ceux marqués ⚠️ par budget_stock_lines (lines suit le classement)
+    limit= date.today()+ timedelta(days=EXPIRY_RISK_DAYS)
+    at_risk= [p for i, (p, _, _) in enumerate(lines)
+              if i< PROMPT_AT_RISK_ITEMS and p.best_before is not None and p.best_before<= limit]
+    owner= {id(p): i% days for i, p in enumerate(at_risk)}
+
+    prompts= []
+    for day in range(days):
+        mine= [p.product_name for p in at_risk if owner[id(p)]== day][:PLAN_PRIORITY_ITEMS_PER_DAY]
+        body= "".join(line for p, line, _ in lines if owner.get(id(p), day)== day)
+        extra= exclusions_line(exclusions)
+        extra+= f"\nRecette du jour {day+ 1} sur {days} d'un planning : propose un plat différent des autres jours.\n"
+        if mine:
+            extra+= f"Produits à utiliser en priorité aujourd'hui : {', '.join(mine)}.\n"
+        tail= recipe_prompt_tail(note, extra)+ (
+            f"7) Termine par une seule ligne « {PLAN_SHOPPING_PREFIX} » suivie des ingrédients à acheter, "
+            f"séparés par des virgules (« {PLAN_SHOPPING_PREFIX} aucun » si rien).\n"
         )
-        return rep["choices"][0]["message"]["content"]
+        prompts.append(head+ body+ tail)
+
+    prompt_stats.record(shared, len(lines))
+    metrics.size("prompt_tokens", shared)
+    logger.info(f"[Planning] {days} prompts, contexte partagé {shared} tokens, {len(at_risk)} produits à risque répartis")
+    return prompts
+
+def split_shopping_list(text:str)->Tuple[str, List[str]]:
+    """Sépare la recette de sa ligne ACHATS: (renvoie le texte sans cette ligne et les ingrédients)."""
+    items= []
+    kept= []
+    for line in text.splitlines():
+        raw= line.strip().strip("*_ ")
+        if raw.upper().startswith(PLAN_SHOPPING_PREFIX):
+            for it in raw[len(PLAN_SHOPPING_PREFIX):].replace(";", ",").split(","):
+                it= it.strip(" .-*")
+                if it and it.lower() not in ("aucun", "none", "ninguno", "rien"):
+                    items.append(it)
+        else:
+            kept.append(line)
+    return "\n".join(kept).strip(), items
+
+def merge_shopping_lists(lists:List[List[str]])->List[str]:
+    """Fusionne les listes de courses sans doublons (insensible à la casse), dans l'ordre d'apparition."""
+    seen= set()
+    merged= []
+    for items in lists:
+        for it in items:
+            k= it.lower()
+            if k not in seen:
+                seen.add(k)
+                merged.append(it)
+    return merged
+
+OPENAI_ERRORS= ("❌ Erreur OpenAI.", "❌ Erreur inattendue.")
+
+class TokenBucket:
+    """Seau à jetons : `per_minute` jetons par minute, capacité d'une minute par défaut."""
+    def __init__(self, per_minute:float, capacity:Optional[float]= None):
+        self.capacity= float(capacity if capacity is not None else per_minute)
+        self.rate= per_minute/ 60.0
+        self.level= self.capacity
+        self._t= time.monotonic()
+
+    def _refill(self):
+        now= time.monotonic()
+        self.level= min(self.capacity, self.level+ (now- self._t)* self.rate)
+        self._t= now
+
+    def delay(self, n:float)->float:
+        """Secondes à attendre avant de pouvoir prendre n jetons (0 si disponibles)."""
+        self._refill()
+        n= min(n, self.capacity)
+        return 0.0 if self.level>= n else (n- self.level)/ self.rate
+
+    def take(self, n:float):
+        self._refill()
+        self.level-= n
+
+    def give_back(self, n:float):
+        """Restitue des jetons réservés en trop (estimation > consommation réelle)."""
+        self._refill()
+        self.level= min(self.capacity, self.level+ n)
+
+class LLMScheduler:
+    """
+    Ordonnanceur central des appels OpenAI :
+    - deux seaux à jetons (requêtes/minute et tokens/minute) ;
+    - une file par chat, servies à tour de rôle (un chat qui lance un planning
+      de 7 recettes ne bloque pas les autres) ;
+    - pause globale sur 429 (Retry-After) au lieu de multiplier les échecs.
+    """
+    def __init__(self, rpm:int, tpm:int):
+        self.requests= TokenBucket(rpm)
+        self.tokens= TokenBucket(tpm)
+        self._queues: "OrderedDict[object, deque]"= OrderedDict()
+        self._wakeup= asyncio.Event()
+        self._task: Optional[asyncio.Task]= None
+        self._paused_until= 0.0
+
+    def queued(self)->int:
+        return sum(len(q) for q in self._queues.values())
+
+    def _position(self, key)->int:
+        """Rang (1 = prochain) d'une nouvelle demande de `key` dans le tour de rôle."""
+        mine= len(self._queues.get(key, ()))
+        ahead= sum(min(len(q), mine+ 1) for k, q in self._queues.items() if k!= key)
+        return ahead+ mine+ 1
+
+    async def acquire(self, key, cost:float, on_queued: Optional[Callable[[int], Awaitable[None]]]= None):
+        """Attend son tour (équité par chat) et la disponibilité des deux seaux."""
+        if self._task is None or self._task.done():
+            self._task= asyncio.get_running_loop().create_task(self._run())
+        position= self._position(key)
+        fut= asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append((fut, cost))
+        self._wakeup.set()
+        if on_queued is not None and not fut.done() and (position> 1 or self._wait_for(cost)> 1):
+            try:
+                await on_queued(position)
+            except Exception as e:
+                logger.warning(f"[LLM] Message de file impossible: {e}")
+        t0= time.monotonic()
+        await fut
+        metrics.observe("llm_queue_wait", time.monotonic()- t0)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task= None
+
+    def retry_after(self, seconds:float):
+        """Le fournisseur a répondu 429 : plus aucun appel avant `seconds`."""
+        self._paused_until= max(self._paused_until, time.monotonic()+ seconds)
+
+    def _wait_for(self, cost:float)->float:
+        return max(self._paused_until- time.monotonic(), self.requests.delay(1), self.tokens.delay(cost))
+
+    async def _run(self):
+        while True:
+            if not self._queues:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            key, q= next(iter(self._queues.items()))
+            fut, cost= q[0]
+            if fut.cancelled():
+                q.popleft()
+            else:
+                wait= self._wait_for(cost)
+                if wait> 0:
+                    await asyncio.sleep(wait)
+                    continue
+                q.popleft()
+                self.requests.take(1)
+                self.tokens.take(cost)
+                fut.set_result(None)
+            # Chat suivant au prochain tour
+            if q:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+
+llm_scheduler= LLMScheduler(OPENAI_RPM, OPENAI_TPM)
+
+def _retry_after_seconds(e: Exception, attempt:int)->float:
+    headers= getattr(e, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return min(60.0, 2.0** attempt)
+
+@instrumented("call_openai_chatgpt")
+async def stream_openai_chatgpt(prompt:str, chat_id= None,
+                                on_queued: Optional[Callable[[int], Awaitable[None]]]= None)->AsyncIterator[str]:
+    """
+    Envoie le prompt à gpt-4o en streaming et renvoie les morceaux de texte au fil de l'eau.
+    L'appel passe par llm_scheduler (limites RPM/TPM, file équitable par chat) ;
+    un 429 avant le premier morceau est réessayé après le délai Retry-After.
+    """
+    openai.api_key= OPENAI_API_KEY
+    cost= count_tokens(prompt)+ OPENAI_EXPECTED_COMPLETION_TOKENS
+    try:
+        for attempt in range(OPENAI_MAX_RETRIES+ 1):
+            await llm_scheduler.acquire(chat_id, cost, on_queued)
+            on_queued= None  # la position n'est annoncée qu'une fois
+            received= 0
+            try:
+                stream= await openai.ChatCompletion.acreate(
+                    model=OPENAI_MODEL,
+                    messages=[{"role":"user","content":prompt}],
+                    temperature=0.7,
+                    stream=True
+                )
+                async for chunk in stream:
+                    delta= chunk["choices"][0].get("delta", {}).get("content")
+                    if delta:
+                        received+= len(delta)
+                        yield delta
+            except openai.error.RateLimitError as e:
+                if received or attempt== OPENAI_MAX_RETRIES:
+                    raise
+                wait= _retry_after_seconds(e, attempt)
+                llm_scheduler.retry_after(wait)
+                metrics.error("openai_rate_limited")
+                logger.warning(f"[LLM] 429, nouvel essai dans {wait:.1f}s ({attempt+ 1}/{OPENAI_MAX_RETRIES})")
+                continue
+            # ~4 caractères par token : on rend la réserve de réponse non consommée
+            llm_scheduler.tokens.give_back(max(0, OPENAI_EXPECTED_COMPLETION_TOKENS- received// 4))
+            return
     except openai.OpenAIError as e:
+        metrics.error("call_openai_chatgpt")
         logger.error(f"OpenAIError: {e}")
-        return "❌ Erreur OpenAI."
+        yield "\n"+ OPENAI_ERRORS[0]
     except Exception as ex:
+        metrics.error("call_openai_chatgpt")
         logger.error(f"Erreur inattendue openai: {ex}")
-        return "❌ Erreur inattendue."
+        yield "\n"+ OPENAI_ERRORS[1]
+
+async def complete_openai_chatgpt(prompt:str, chat_id= None)->str:
+    """Réponse complète (sans affichage progressif) pour un prompt."""
+    parts= [d async for d in stream_openai_chatgpt(prompt, chat_id)]
+    return "".join(parts).strip()
+
+async def call_openai_chatgpt(stock_data:list, convives:list, note:str, nb_convives:int)->str:
+    """Version non interactive : renvoie la recette complète."""
+    prompt= build_recipe_prompt(stock_data, convives, note, nb_convives)
+    return await complete_openai_chatgpt(prompt)
+
+# -------------------------------------------------------------------
+# Cache des recettes (stock + convives + note + langue)
+# -------------------------------------------------------------------
+_fingerprint_memo: Dict[int, tuple]= {}
+
+def stock_fingerprint(stock_data:list)->str:
+    """Empreinte des champs du stock utilisés par le prompt (mémorisée par snapshot)."""
+    memo= _fingerprint_memo.get(id(stock_data))
+    if memo is not None and memo[0] is stock_data:
+        return memo[1]
+    h= hashlib.sha256()
+    for p in stock_data:
+        h.update(f"{p.product_name}\x1f{p.amount}\x1f{p.best_before_date}\x1e".encode("utf-8"))
+    fp= h.hexdigest()
+    _fingerprint_memo.clear()
+    _fingerprint_memo[id(stock_data)]= (stock_data, fp)
+    return fp
+
+def recipe_cache_key(stock_data:list, convives:list, note:str, nb_convives:int)->str:
+    """
+    Clé = empreinte du stock + convives (avec leurs aliments non supportés)
+    + nombre de convives + note + langue.
+    """
+    payload= json.dumps({
+        "stock": stock_fingerprint(stock_data),
+        "convives": sorted([c["name"].lower(), c["aliments_non_supportes"]] for c in convives),
+        "nb": nb_convives,
+        "note": note.strip().lower(),
+        "lang": LANGUAGE,
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class RecipeCache:
+    """Cache LRU des recettes générées, avec persistance optionnelle sur disque (JSON)."""
+    def __init__(self, max_entries:int, file_path:Optional[str]= None):
+        self.max_entries= max_entries
+        self.file_path= file_path
+        self.hits= 0
+        self.misses= 0
+        self._data: "OrderedDict[str, str]"= OrderedDict()
+
+    def load(self):
+        if not self.file_path or not os.path.exists(self.file_path):
+            return
+        try:
+            with open(self.file_path,'r', encoding='utf-8') as f:
+                for k, v in json.load(f):
+                    self._data[k]= v
+            while len(self._data)> self.max_entries:
+                self._data.popitem(last=False)
+            logger.info(f"[Recettes] {len(self._data)} recettes chargées depuis {self.file_path}")
+        except Exception as e:
+            logger.error(f"Erreur lecture cache recettes: {e}")
+
+    def _save(self):
+        if not self.file_path:
+            return
+        tmp= self.file_path+ ".tmp"
+        try:
+            with open(tmp,'w', encoding='utf-8') as f:
+                json.dump(list(self._data.items()), f, ensure_ascii=False)
+            os.replace(tmp, self.file_path)
+        except Exception as e:
+            logger.error(f"Erreur écriture cache recettes: {e}")
+
+    def get(self, key:str)->Optional[str]:
+        rep= self._data.get(key)
+        if rep is None:
+            self.misses+= 1
+            return None
+        self._data.move_to_end(key)
+        self.hits+= 1
+        return rep
+
+    def put(self, key:str, recipe:str):
+        self._data[key]= recipe
+        self._data.move_to_end(key)
+        while len(self._data)> self.max_entries:
+            self._data.popitem(last=False)
+        self._save()
+
+    def stats(self)->Dict[str, float]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._data)}
+
+recipe_cache= RecipeCache(RECIPE_CACHE_SIZE, RECIPE_CACHE_FILE)
+
+# -------------------------------------------------------------------
+# Envois Telegram : découpage UTF-16 et file avec limites de débit
+# -------------------------------------------------------------------
+def utf16_len(text:str)->int:
+    """Longueur telle que la compte Telegram (unités UTF-16)."""
+    return len(text.encode("utf-16-le"))// 2
+
+def _joins_previous(ch:str)->bool:
+    """Caractère qui ne peut pas commencer un morceau (ZWJ, sélecteur de variante, teinte, accent combinant)."""
+    return ch in "\u200d\ufe0f" or "\U0001f3fb"<= ch<= "\U0001f3ff" or unicodedata.combining(ch)> 0
+
+def _utf16_cut(text:str, limit:int)->int:
+    """Plus grand index i tel que text[:i] tienne en `limit` unités UTF-16, sans couper un emoji composé."""
+    units= 0
+    i= 0
+    for i, ch in enumerate(text):
+        units+= 2 if ord(ch)> 0xFFFF else 1
+        if units> limit:
+            break
+    else:
+        return len(text)
+    while i> 0 and (_joins_previous(text[i]) or text[i- 1]== "\u200d"):
+        i-= 1
+    return i
+
+def split_message(text:str, limit:int= TELEGRAM_MAX_LEN)->List[str]:
+    """Découpe en messages de `limit` unités UTF-16 max, de préférence entre paragraphes, puis lignes, puis mots."""
+    parts= []
+    while utf16_len(text)> limit:
+        cut= _utf16_cut(text, limit)
+        window= text[:cut]
+        for sep in ("\n\n", "\n", " "):
+            i= window.rfind(sep)
+            if i> cut// 2:
+                cut= i+ len(sep)
+                break
+        part= text[:cut].rstrip()
+        if part:
+            parts.append(part)
+        text= text[cut:].lstrip("\n ")
+    if text.strip():
+        parts.append(text)
+    return parts
+
+class TelegramSender:
+    """
+    File d'envoi des messages :
+    - intervalle minimal entre deux messages d'un même chat (plus long pour les groupes) ;
+    - débit global borné (seau à jetons) ;
+    - RetryAfter : le chat concerné est mis en pause puis le message réessayé ;
+    - les petits messages texte en attente pour un même chat sont regroupés en un seul envoi.
+    Les chats prêts sont servis à tour de rôle. call() passe par les mêmes
+    limites pour les autres appels (photos, éditions de message).
+    """
+    def __init__(self, per_second:float, chat_interval:float, group_interval:float, max_retries:int):
+        self.bucket= TokenBucket(per_second* 60, capacity=per_second)
+        self.chat_interval= chat_interval
+        self.group_interval= group_interval
+        self.max_retries= max_retries
+        self._queues: "OrderedDict[int, deque]"= OrderedDict()
+        self._next_at: Dict[int, float]= {}
+        self._busy: Set[int]= set()
+        self._wakeup= asyncio.Event()
+        self._task: Optional[asyncio.Task]= None
+        self._sending: Set[asyncio.Task]= set()
+
+    def queued(self)->int:
+        return sum(len(q) for q in self._queues.values())
+
+    def send(self, bot, chat_id:int, text:str, **kwargs)->asyncio.Future:
+        """Met le message en file ; le futur donne le Message envoyé."""
+        return self._enqueue(chat_id, [bot, text, kwargs, [], 0, None])
+
+    def call(self, chat_id:int, fn:Callable[[], Awaitable])->asyncio.Future:
+        """Met en file un autre appel à l'API Bot pour ce chat ; fn() peut être rappelée après RetryAfter."""
+        return self._enqueue(chat_id, [None, None, {}, [], 0, fn])
+
+    def _enqueue(self, chat_id:int, job:list)->asyncio.Future:
+        if self._task is None or self._task.done():
+            self._task= asyncio.get_running_loop().create_task(self._run())
+        fut= asyncio.get_running_loop().create_future()
+        job[3].append(fut)
+        self._queues.setdefault(chat_id, deque()).append(job)
+        self._wakeup.set()
+        return fut
+
+    def _interval(self, chat_id:int)->float:
+        return self.group_interval if chat_id< 0 else self.chat_interval
+
+    def _take_job(self, q:deque)->list:
+        """Premier message de la file, fusionné avec les messages texte simples qui le suivent."""
+        job= q.popleft()
+        bot, text, kwargs, futs, tries, fn= job
+        if kwargs or fn is not None:
+            return job
+        while q and not q[0][2] and q[0][5] is None and q[0][0] is bot:
+            merged= text+ "\n\n"+ q[0][1]
+            if utf16_len(merged)> TELEGRAM_MAX_LEN:
+                break
+            text= merged
+            futs.extend(q.popleft()[3])
+        if len(futs)> 1:
+            metrics.size("telegram_batched", len(futs))
+        return [bot, text, kwargs, futs, tries, None]
+
+    async def _run(self):
+        while True:
+            now= time.monotonic()
+            wait= None
+            for chat_id in list(self._queues):
+                if chat_id in self._busy:
+                    continue
+                ready= max(self._next_at.get(chat_id, 0.0), now+ self.bucket.delay(1))
+                if ready> now:
+                    wait= ready- now if wait is None else min(wait, ready- now)
+                    continue
+                q= self._queues.pop(chat_id)
+                job= self._take_job(q)
+                if q:
+                    self._queues[chat_id]= q  # fin du tour de rôle
+                self.bucket.take(1)
+                self._busy.add(chat_id)
+                self._next_at[chat_id]= now+ self._interval(chat_id)
+                task= asyncio.get_running_loop().create_task(self._deliver(chat_id, job))
+                self._sending.add(task)
+                task.add_done_callback(self._sending.discard)
+                wait= 0
+                break
+            if wait== 0:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, chat_id:int, job:list):
+        bot, text, kwargs, futs, tries, fn= job
+        try:
+            if fn is not None:
+                msg= await fn()
+            else:
+                msg= await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        except RetryAfter as e:
+            if tries< self.max_retries:
+                logger.warning(f"[Telegram] RetryAfter {e.retry_after}s (chat {chat_id})")
+                metrics.error("telegram_retry_after")
+                self._next_at[chat_id]= time.monotonic()+ e.retry_after
+                job[4]+= 1
+                self._queues.setdefault(chat_id, deque()).appendleft(job)
+                self._queues.move_to_end(chat_id, last=False)
+                return
+            self._fail(futs, e)
+        except Exception as e:
+            self._fail(futs, e)
+        else:
+            for fut in futs:
+                if not fut.done():
+                    fut.set_result(msg)
+        finally:
+            self._busy.discard(chat_id)
+            self._wakeup.set()
+
+    @staticmethod
+    def _fail(futs:list, e:Exception):
+        for fut in futs:
+            if not fut.done():
+                fut.set_exception(e)
+
+    async def stop(self):
+        """Laisse partir les messages en file (bornée dans le temps) puis arrête la boucle."""
+        deadline= time.monotonic()+ 10
+        while (self._queues or self._sending) and time.monotonic()< deadline:
+            await asyncio.sleep(0.1)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task= None
+
+telegram_sender= TelegramSender(
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_INTERVAL, TELEGRAM_GROUP_INTERVAL, TELEGRAM_SEND_RETRIES
+)
 
 # -------------------------------------------------------------------
 # Helpers
 # -------------------------------------------------------------------
+async def reply(update: Update, text:str, **kwargs):
+    """
+    Répond dans le chat de l'update via telegram_sender (limites par chat et
+    globale, RetryAfter) ; comme reply_text, cite le message dans les groupes.
+    """
+    chat= update.effective_chat
+    if chat.type!= Chat.PRIVATE and update.message is not None:
+        kwargs.setdefault("reply_to_message_id", update.message.message_id)
+    return await telegram_sender.send(update.get_bot(), chat.id, text, **kwargs)
+
+async def reply_photo(update: Update, photo, **kwargs):
+    """Photo (file_id ou octets) dans le chat de l'update, via telegram_sender."""
+    chat_id= update.effective_chat.id
+    bot= update.get_bot()
+    return await telegram_sender.call(chat_id, lambda: bot.send_photo(chat_id=chat_id, photo=photo, **kwargs))
+
+@instrumented()
 async def telegram_send_long_message(context: ContextTypes.DEFAULT_TYPE, chat_id:int, text:str):
-    """Envoie un (ou plusieurs) messages si le texte dépasse 4096 caractères."""
-    max_len=4000
-    for i in range(0,len(text),max_len):
-        part= text[i:i+max_len]
-        await context.bot.send_message(chat_id=chat_id, text=part)
+    """
+    Envoie le texte via telegram_sender, découpé aux paragraphes sous la limite
+    UTF-16 de Telegram ; attend que tous les morceaux soient partis.
+    """
+    metrics.size("telegram_send_long_message", len(text))
+    futs= [telegram_sender.send(context.bot, chat_id, part) for part in split_message(text)]
+    if futs:
+        await asyncio.gather(*futs)
+
+@instrumented()
+async def telegram_stream_message(context: ContextTypes.DEFAULT_TYPE, chat_id:int, chunks: AsyncIterator[str])->str:
+    """
+    Affiche un texte produit en streaming dans UN message Telegram édité au fil de l'eau
+    (éditions espacées de STREAM_EDIT_INTERVAL). Au-delà de TELEGRAM_MAX_LEN, on arrête
+    d'éditer (coupure au paragraphe) et la suite part via telegram_send_long_message à la fin du flux.
+    Renvoie le texte complet.
+    """
+    t0= time.monotonic()
+    text= ""
+    shown= ""
+    msg= None
+    next_edit= 0.0
+    full= False
+    async for delta in chunks:
+        text+= delta
+        if full or not text.strip():
+            continue
+        now= time.monotonic()
+        if msg is None:
+            shown= split_message(text)[0]
+            msg= await telegram_sender.send(context.bot, chat_id, shown)
+            logger.info(f"[Stream] Premier texte visible après {now- t0:.2f}s (chat {chat_id})")
+            next_edit= now+ STREAM_EDIT_INTERVAL
+        elif now>= next_edit:
+            shown= split_message(text)[0]
+            next_edit= await _edit_stream_message(msg, shown, now)
+        full= utf16_len(text)> TELEGRAM_MAX_LEN
+
+    text= text.strip()
+    if not text:
+        return ""
+    if msg is None:
+        await telegram_send_long_message(context, chat_id, text)
+    else:
+        parts= split_message(text)
+        if parts[0]!= shown:
+            await _edit_stream_message(msg, parts[0], time.monotonic(), final=True)
+        if len(parts)> 1:
+            await telegram_send_long_message(context, chat_id, "\n\n".join(parts[1:]))
+    logger.info(f"[Stream] Recette complète en {time.monotonic()- t0:.2f}s ({len(text)} caractères)")
+    return text
+
+async def _edit_stream_message(msg, text:str, now:float, final:bool=False)->float:
+    """
+    Édite le message streamé via telegram_sender ; renvoie l'instant à partir
+    duquel rééditer.
+    """
+    try:
+        await telegram_sender.call(msg.chat_id, lambda: msg.edit_text(text))
+    except RetryAfter as e:
+        # RetryAfter persistant (essais de telegram_sender épuisés)
+        if not final:
+            return now+ e.retry_after
+        await asyncio.sleep(e.retry_after)
+        await telegram_sender.call(msg.chat_id, lambda: msg.edit_text(text))
+    except BadRequest as e:
+        # "Message is not modified" : rien à faire
+        if "not modified" not in str(e).lower():
+            raise
+    return now+ STREAM_EDIT_INTERVAL
+
+def stale_notice(hh:"Household")->str:
+    """Avertissement (avec l'âge du stock) quand le stock servi n'a pas pu être rafraîchi ; sinon ""."""
+    age= hh.stock_cache.stale_age()
+    if age is None:
+        return ""
+    return TEXTS[LANGUAGE]["stock_stale"].format(age=format_age(age))+ "\n"
 
 def get_main_menu():
     """Renvoie le clavier principal."""
     kb= [
         ["➕ Créer Utilisateur", "➖ Supprimer Utilisateur"],
         ["🔧 Modifier Convive", "🍽️ Générer Recette"],
+        ["🔄 Regénérer Recette", "📅 Planning Semaine"],
         ["❌ Quitter"]
     ]
     return ReplyKeyboardMarkup(kb, resize_keyboard=True)
 
-def match_all_words(product_name:str, barcodes:list, query_words:list)->bool:
+def match_all_words(item:StockItem, query_words:list)->bool:
     """
     Retourne True si TOUS les mots de query_words apparaissent
-    soit dans product_name, soit dans un code-barres, sans ordre imposé.
+    soit dans le nom du produit, soit dans un code-barres, sans ordre imposé.
     """
-    pn_lower= product_name.lower()
-    bc_lower= [b.lower() for b in barcodes]
+    pn_lower= item.name_lower
+    bc_lower= item.barcodes_lower
 
     for w in query_words:
         if not ((w in pn_lower) or any(w in bc for bc in bc_lower)):
@@ -346,60 +2871,146 @@ def match_all_words(product_name:str, barcodes:list, query_words:list)->bool:
 # -------------------------------------------------------------------
 # fallback => recherche
 # -------------------------------------------------------------------
+@instrumented("handler_fallback_handler")
+@holds_household
 async def fallback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query= update.message.text.strip()
     if not query:
         return await start_handler(update, context)
 
-    stock= get_grocy_stock()
+    hh= household_of(update)
+    stock= await hh.get_stock()
     if not stock:
-        await update.message.reply_text(TEXTS[LANGUAGE]["no_stock_found"])
+        await reply(update, TEXTS[LANGUAGE]["no_stock_found"])
         return ConversationHandler.END
 
-    # On sépare la requête en mots
-    words= query.lower().split()
-    found=[]
-    for p in stock:
-        if match_all_words(p["product_name"], p["barcodes"], words):
-            found.append(p)
+    # Recherche dans l'index inversé, résultats classés par pertinence
+    ids= hh.stock_index.ranked_search(query)
 
-    if not found:
+    if not ids:
         msg= f"{TEXTS[LANGUAGE]['barcode_not_found']} '{query}'\n{TEXTS[LANGUAGE]['start_menu_label']}"
-        await update.message.reply_text(msg)
+        await reply(update, msg)
+        return ConversationHandler.END
+    # On ne garde que les identifiants (état compact et persistable) ;
+    # seule la première page est rendue maintenant
+    context.user_data["search_results"]= ids
+    text, markup= render_search_page(hh.stock_index, ids, 0)
+    await reply(update, stale_notice(hh)+ text, reply_markup=markup)
+    return SEARCH_GROCY_RESULTS
+
+@instrumented("handler_photo_handler")
+@holds_household
+async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Photo d'un code-barres => lecture locale puis recherche exacte dans l'index."""
+    if not barcode_scanner.available():
+        await reply(update, TEXTS[LANGUAGE]["barcode_photo_unavailable"])
         return ConversationHandler.END
-    else:
-        context.user_data["search_results"]= found
-        # On affiche : Nom, Qté, Code-Barres
-        listing= ""
-        for i, pr in enumerate(found,1):
-            bc_str= ", ".join(pr["barcodes"])
-            listing+= (
-                f"{i}) {pr['product_name']} "
-                f"(Qté:{pr['amount']}, Code-Barres:{bc_str})\n"
-            )
-        listing+= "\n" + TEXTS[LANGUAGE]["fallback_menu"]
-        await update.message.reply_text(listing)
-        return SEARCH_GROCY_RESULTS
 
+    # Plus petite taille fournie par Telegram suffisante pour le décodage (moins à télécharger)
+    sizes= sorted(update.message.photo, key=lambda p: p.width* p.height)
+    photo= next((p for p in sizes if max(p.width, p.height)>= BARCODE_SCAN_MAX_SIDE), sizes[-1])
+    f= await photo.get_file()
+    data= bytes(await f.download_as_bytearray())
+    try:
+        codes= await barcode_scanner.scan(data)
+    except Exception as e:
+        logger.warning(f"[Code-barres] Décodage impossible: {e}")
+        codes= []
+    if not codes:
+        await reply(update, TEXTS[LANGUAGE]["barcode_photo_none"])
+        return ConversationHandler.END
+
+    hh= household_of(update)
+    stock= await hh.get_stock()
+    if not stock:
+        await reply(update, TEXTS[LANGUAGE]["no_stock_found"])
+        return ConversationHandler.END
+    ids= []
+    for code in codes:
+        for v in barcode_variants(code):
+            for p in hh.stock_index.lookup_barcode(v):
+                pid= str(p.product_id)
+                if pid not in ids:
+                    ids.append(pid)
+    if not ids:
+        msg= f"{TEXTS[LANGUAGE]['barcode_not_found']} '{', '.join(codes)}'\n{TEXTS[LANGUAGE]['start_menu_label']}"
+        await reply(update, msg)
+        return ConversationHandler.END
+    context.user_data["search_results"]= ids
+    text, markup= render_search_page(hh.stock_index, ids, 0)
+    await reply(update, stale_notice(hh)+ f"📷 {', '.join(codes)}\n"+ text, reply_markup=markup)
+    return SEARCH_GROCY_RESULTS
+
+def render_search_page(index:StockSearchIndex, ids:list, page:int):
+    """Texte + boutons ⬅️/➡️ d'une page de résultats (numérotation globale)."""
+    pages= max(1, (len(ids)+ SEARCH_PAGE_SIZE- 1)// SEARCH_PAGE_SIZE)
+    page= min(max(0, page), pages- 1)
+    start= page* SEARCH_PAGE_SIZE
+    lines= []
+    for i, pid in enumerate(ids[start:start+ SEARCH_PAGE_SIZE], start+ 1):
+        pr= index.get(pid)
+        if pr is None:
+            continue
+        bc_str= ", ".join(pr.barcodes)
+        lines.append(f"{i}) {pr.product_name} (Qté:{pr.amount}, Code-Barres:{bc_str})")
+    if pages> 1:
+        lines.append("\n"+ TEXTS[LANGUAGE]["search_page_footer"].format(
+            page=page+ 1, pages=pages, n=len(ids)))
+    lines.append("\n"+ TEXTS[LANGUAGE]["fallback_menu"])
+    buttons= []
+    if page> 0:
+        buttons.append(InlineKeyboardButton("⬅️", callback_data=f"page:{page- 1}"))
+    if page< pages- 1:
+        buttons.append(InlineKeyboardButton("➡️", callback_data=f"page:{page+ 1}"))
+    markup= InlineKeyboardMarkup([buttons]) if buttons else None
+    return "\n".join(lines), markup
+
+@instrumented("handler_search_page_handler")
+@holds_household
+async def search_page_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Bouton ⬅️/➡️ : rend la page demandée à la volée. Enregistré hors de la
+    conversation (ne change pas d'état) : les résultats viennent de user_data.
+    """
+    q= update.callback_query
+    await q.answer()
+    ids= context.user_data.get("search_results", [])
+    if not ids:
+        return
+    hh= household_of(update)
+    await hh.get_stock()
+    text, markup= render_search_page(hh.stock_index, ids, int(q.data.split(":", 1)[1]))
+    try:
+        await telegram_sender.call(update.effective_chat.id, lambda: q.edit_message_text(text, reply_markup=markup))
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+
+@instrumented("handler_search_grocy_results_handler")
+@holds_household
 async def search_grocy_results_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     c= update.message.text.strip()
     if not c.isdigit():
-        await update.message.reply_text(TEXTS[LANGUAGE]["invalid_number"])
+        await reply(update, TEXTS[LANGUAGE]["invalid_number"])
         return SEARCH_GROCY_RESULTS
 
     idx= int(c)-1
     results= context.user_data.get("search_results",[])
     if idx<0 or idx>= len(results):
-        await update.message.reply_text("Numéro invalide.")
+        await reply(update, "Numéro invalide.")
         return SEARCH_GROCY_RESULTS
 
-    sel= results[idx]
-    context.user_data["selected_product"]= sel
-    bc_str= ", ".join(sel["barcodes"])
+    hh= household_of(update)
+    sel= await hh.resolve_product(results[idx])
+    if sel is None:
+        await reply(update, TEXTS[LANGUAGE]["product_gone"])
+        return ConversationHandler.END
+    context.user_data["selected_product"]= results[idx]
+    bc_str= ", ".join(sel.barcodes)
     detail= (
-        f"**{sel['product_name']}**\n"
-        f"Qté: {sel['amount']}\n"
-        f"Date péremption: {sel['best_before_date']}\n"
+        f"**{sel.product_name}**\n"
+        f"Qté: {sel.amount}\n"
+        f"Date péremption: {sel.best_before_date}\n"
         f"Code-Barres: {bc_str}\n\n"
         "👉 Choisissez : Ajouter / Supprimer / Liste / Quitter"
     )
@@ -407,140 +3018,227 @@ async def search_grocy_results_handler(update: Update, context: ContextTypes.DEF
         ["Ajouter","Supprimer","Liste"],
         ["Quitter"]
     ]
-    await update.message.reply_text(detail, parse_mode="Markdown",
+    await reply(update, detail, parse_mode="Markdown",
         reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
     )
+    if sel.picture_url:
+        # Photo en arrière-plan : le détail n'attend pas un éventuel téléchargement.
+        # Le foyer reste réservé (in_use) jusqu'à la fin de l'envoi.
+        hh.in_use+= 1
+        def release(_task):
+            hh.in_use-= 1
+        context.application.create_task(
+            send_product_picture(update, hh.pictures, sel.picture_url)
+        ).add_done_callback(release)
     return SEARCH_GROCY_DETAIL
 
+async def send_product_picture(update: Update, picture_cache:ProductPictureCache, url:str):
+    """
+    Envoie la photo par file_id si déjà connue, sinon depuis le cache disque
+    (puis mémorise le file_id). Lancée en tâche de fond : n'échoue jamais.
+    """
+    fid= picture_cache.file_id(url)
+    if fid:
+        try:
+            await reply_photo(update, fid)
+            return
+        except BadRequest:
+            picture_cache.forget(url)
+        except Exception as e:
+            logger.warning(f"[Photos] Envoi impossible: {e}")
+            return
+    path= await picture_cache.get_path(url)
+    if not path:
+        return
+    try:
+        # Octets plutôt que fichier ouvert : l'envoi peut être rejoué après RetryAfter
+        with open(path,'rb') as f:
+            data= f.read()
+        msg= await reply_photo(update, data)
+        picture_cache.remember(url, msg.photo[-1].file_id)
+    except Exception as e:
+        logger.warning(f"[Photos] Envoi impossible: {e}")
+
+@instrumented("handler_search_grocy_detail_handler")
+@holds_household
 async def search_grocy_detail_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     c= update.message.text.strip().lower()
-    sel= context.user_data.get("selected_product",{})
+    sel= await household_of(update).resolve_product(context.user_data.get("selected_product"))
     if c=="quitter":
-        await update.message.reply_text(TEXTS[LANGUAGE]["start_menu_label"])
+        await reply(update, TEXTS[LANGUAGE]["start_menu_label"])
         return ConversationHandler.END
     if c=="liste":
-        logger.info(f"[Fictif] Ajout liste => {sel.get('product_name','?')}")
-        await update.message.reply_text(TEXTS[LANGUAGE]["product_to_list"])
+        logger.info(f"[Fictif] Ajout liste => {sel.product_name if sel else '?'}")
+        await reply(update, TEXTS[LANGUAGE]["product_to_list"])
         return ConversationHandler.END
     if c in ["ajouter","supprimer"]:
         context.user_data["action"]= c
-        await update.message.reply_text(TEXTS[LANGUAGE]["choose_quantity"],
+        await reply(update, TEXTS[LANGUAGE]["choose_quantity"],
             reply_markup=ReplyKeyboardRemove())
         return SEARCH_GROCY_QUANTITY
 
-    await update.message.reply_text(TEXTS[LANGUAGE]["invalid_choice"])
+    await reply(update, TEXTS[LANGUAGE]["invalid_choice"])
     return SEARCH_GROCY_DETAIL
 
+@instrumented("handler_search_grocy_quantity_handler")
+@holds_household
 async def search_grocy_quantity_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     qstr= update.message.text.strip()
-    if not qstr.isdigit():
-        await update.message.reply_text(TEXTS[LANGUAGE]["invalid_number"])
+    if not qstr.isdigit() or int(qstr)== 0:
+        await reply(update, TEXTS[LANGUAGE]["invalid_number"])
         return SEARCH_GROCY_QUANTITY
 
     qty= int(qstr)
     action= context.user_data.get("action","ajouter")
-    sel= context.user_data.get("selected_product",{})
-    old= sel["amount"]
-    new_amt= old+ qty if action=="ajouter" else max(0, old- qty)
-    # On met à jour Grocy
-    update_grocy_product(sel["product_id"], new_amt)
-    sel["amount"]= new_amt
-    await update.message.reply_text(TEXTS[LANGUAGE]["product_updated"])
+    hh= household_of(update)
+    sel= await hh.resolve_product(context.user_data.get("selected_product"))
+    if sel is None:
+        await reply(update, TEXTS[LANGUAGE]["product_gone"])
+        return ConversationHandler.END
+    # Quantité demandée telle quelle : le stock réel (pas le snapshot) décide,
+    # apply_grocy_delta consomme au plus ce qui reste et la confirmation le dit
+    delta= qty if action=="ajouter" else -qty
+    # Écriture différée et regroupée ; confirmation quand Grocy a répondu
+    fut= hh.writes.submit(sel.product_id, delta)
+    await reply(update, TEXTS[LANGUAGE]["product_update_queued"])
+    context.application.create_task(
+        _confirm_grocy_write(context, update.effective_chat.id, sel.product_name, fut)
+    )
     return ConversationHandler.END
 
+async def _confirm_grocy_write(context: ContextTypes.DEFAULT_TYPE, chat_id:int, name:str, fut:asyncio.Future):
+    requested, applied= await fut
+    T= TEXTS[LANGUAGE]
+    if applied is None:
+        msg= T["product_update_failed"].format(name=name)
+    elif applied== 0 and requested< 0:
+        msg= T["product_consume_empty"].format(name=name)
+    elif applied!= requested:
+        msg= T["product_consume_partial"].format(name=name, done=-applied)
+    else:
+        msg= T["product_updated"]
+    await telegram_sender.send(context.bot, chat_id, msg)
+
 # -------------------------------------------------------------------
 # /start
 # -------------------------------------------------------------------
+@instrumented("handler_start_handler")
+@holds_household
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     welcome_msg= TEXTS[LANGUAGE]["welcome"]
-    await update.message.reply_text(welcome_msg, reply_markup=get_main_menu())
+    await reply(update, welcome_msg, reply_markup=get_main_menu())
     return MAIN_MENU
 
 # -------------------------------------------------------------------
 # main_menu_handler
 # -------------------------------------------------------------------
+@instrumented("handler_main_menu_handler")
+@holds_household
 async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     c= update.message.text.strip()
     if c== "➕ Créer Utilisateur":
-        await update.message.reply_text("Nom du convive ?", 
+        await reply(update, "Nom du convive ?", 
             reply_markup=ReplyKeyboardRemove())
         return CREER_UTILISATEUR_STATE
 
     elif c== "➖ Supprimer Utilisateur":
-        await update.message.reply_text("Nom du convive à supprimer ?",
+        await reply(update, "Nom du convive à supprimer ?",
             reply_markup=ReplyKeyboardRemove())
         return SUPPRIMER_UTILISATEUR_STATE
 
     elif c== "🔧 Modifier Convive":
-        convs= read_convives(CONVIVES_CSV)
+        convs= read_convives(household_of(update).convives)
         if not convs:
-            await update.message.reply_text("Aucun convive dans le CSV.",
+            await reply(update, "Aucun convive enregistré.",
                 reply_markup=get_main_menu())
             return MAIN_MENU
         rec= "Liste convives:\n"
         for v in convs:
             rec+= f"- {v['name']} (Non supportés: {v['aliments_non_supportes']})\n"
         rec+= "\nEx: Bob gluten, lactose"
-        await update.message.reply_text(rec, reply_markup=ReplyKeyboardRemove())
+        await reply(update, rec, reply_markup=ReplyKeyboardRemove())
         return MODIFIER_UTILISATEUR_STATE
 
     elif c== "🍽️ Générer Recette":
-        await update.message.reply_text("Combien de convives ?",
+        context.user_data.pop("plan_days", None)
+        await reply(update, "Combien de convives ?",
             reply_markup=ReplyKeyboardRemove())
         return GEN_RECETTE_NB_CONVIVES
 
+    elif c== "🔄 Regénérer Recette":
+        last= context.user_data.get("last_recipe")
+        if not last:
+            await reply(update, TEXTS[LANGUAGE]["recipe_nothing_to_regenerate"],
+                reply_markup=get_main_menu())
+            return MAIN_MENU
+        return await generate_recipe(update, context, last["convives"], last["nb"], last["note"],
+            regenerate=True)
+
+    elif c== "📅 Planning Semaine":
+        await reply(update, TEXTS[LANGUAGE]["plan_days"].format(max=PLAN_MAX_DAYS),
+            reply_markup=ReplyKeyboardRemove())
+        return PLAN_NB_JOURS
+
     elif c== "❌ Quitter":
-        await update.message.reply_text("Au revoir !", 
+        await reply(update, "Au revoir !", 
             reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
 
     else:
-        await update.message.reply_text(TEXTS[LANGUAGE]["invalid_choice"],
+        await reply(update, TEXTS[LANGUAGE]["invalid_choice"],
             reply_markup=get_main_menu())
         return MAIN_MENU
 
 # -------------------------------------------------------------------
 # convives states
 # -------------------------------------------------------------------
+@instrumented("handler_creer_utilisateur_state")
+@holds_household
 async def creer_utilisateur_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
     nom= update.message.text.strip()
-    ok,msg= ajouter_convive(nom, CONVIVES_CSV)
-    await update.message.reply_text(msg, reply_markup=get_main_menu())
+    ok,msg= ajouter_convive(nom, household_of(update).convives)
+    await reply(update, msg, reply_markup=get_main_menu())
     return MAIN_MENU
 
+@instrumented("handler_supprimer_utilisateur_state")
+@holds_household
 async def supprimer_utilisateur_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
     nom= update.message.text.strip()
-    ok,msg= supprimer_convive(nom, CONVIVES_CSV)
-    await update.message.reply_text(msg, reply_markup=get_main_menu())
+    ok,msg= supprimer_convive(nom, household_of(update).convives)
+    await reply(update, msg, reply_markup=get_main_menu())
     return MAIN_MENU
 
+@instrumented("handler_modifier_utilisateur_state")
+@holds_household
 async def modifier_utilisateur_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
     inp= update.message.text.strip()
     if " " not in inp:
-        await update.message.reply_text("Format incorrect. Ex: Bob gluten, lactose.")
+        await reply(update, "Format incorrect. Ex: Bob gluten, lactose.")
         return MODIFIER_UTILISATEUR_STATE
     parts= inp.split(" ",1)
     n= parts[0]
     a= parts[1].strip()
-    ok,msg= modifier_aliments_convive(n,a, CONVIVES_CSV)
-    await update.message.reply_text(msg, reply_markup=get_main_menu())
+    ok,msg= modifier_aliments_convive(n,a, household_of(update).convives)
+    await reply(update, msg, reply_markup=get_main_menu())
     return MAIN_MENU
 
 # -------------------------------------------------------------------
 # Génération recette
 # -------------------------------------------------------------------
+@instrumented("handler_generer_nb_convives")
+@holds_household
 async def generer_nb_convives(update: Update, context: ContextTypes.DEFAULT_TYPE):
     c= update.message.text.strip()
     if not c.isdigit():
-        await update.message.reply_text("Entrez un nombre valide.",
+        await reply(update, "Entrez un nombre valide.",
             reply_markup=get_main_menu())
         return MAIN_MENU
     nb= int(c)
     context.user_data["nb_convives"]= nb
 
-    convs= read_convives(CONVIVES_CSV)
+    convs= read_convives(household_of(update).convives)
     if not convs:
-        await update.message.reply_text(
+        await reply(update,
             "Aucun convive dans la base. Entrez la note :",
             reply_markup=ReplyKeyboardRemove()
         )
@@ -552,12 +3250,14 @@ async def generer_nb_convives(update: Update, context: ContextTypes.DEFAULT_TYPE
     for x in convs:
         kb.append([KeyboardButton(x["name"])])
     kb.append([KeyboardButton("Aucun"), KeyboardButton("fin")])
-    await update.message.reply_text(
+    await reply(update,
         f"Sélectionnez jusqu'à {nb} convive(s). Puis tapez 'fin'.",
         reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
     )
     return GEN_RECETTE_SEL_CONVIVES
 
+@instrumented("handler_generer_sel_convives")
+@holds_household
 async def generer_sel_convives(update: Update, context: ContextTypes.DEFAULT_TYPE):
     t= update.message.text.strip().lower()
     sel= context.user_data.get("convives_sel", [])
@@ -565,15 +3265,15 @@ async def generer_sel_convives(update: Update, context: ContextTypes.DEFAULT_TYP
     cl= context.user_data.get("convives_list", [])
 
     if t== "fin":
-        await update.message.reply_text("Entrez la note (ex: 'Protéines'):",
+        await reply(update, "Entrez la note (ex: 'Protéines'):",
             reply_markup=ReplyKeyboardRemove())
         return GEN_RECETTE_NOTE
 
     if t=="aucun":
         if not sel:
-            await update.message.reply_text("Aucun convive sélectionné. Entrez la note :")
+            await reply(update, "Aucun convive sélectionné. Entrez la note :")
         else:
-            await update.message.reply_text(f"Convives: {', '.join(sel)}. Entrez la note :")
+            await reply(update, f"Convives: {', '.join(sel)}. Entrez la note :")
         return GEN_RECETTE_NOTE
 
     if t in [xx.lower() for xx in cl]:
@@ -583,52 +3283,373 @@ async def generer_sel_convives(update: Update, context: ContextTypes.DEFAULT_TYP
         context.user_data["convives_sel"]= sel
         context.user_data["convives_list"]= cl
         if len(sel)>= nb:
-            await update.message.reply_text("Sélection complète. Entrez la note :",
+            await reply(update, "Sélection complète. Entrez la note :",
                 reply_markup=ReplyKeyboardRemove())
             return GEN_RECETTE_NOTE
         else:
-            await update.message.reply_text(
+            await reply(update,
                 f"Convive '{real_name}' ajouté. Tapez 'fin' ou continuez."
             )
     else:
-        await update.message.reply_text("Convive non trouvé. Réessayez ou 'fin'.")
+        await reply(update, "Convive non trouvé. Réessayez ou 'fin'.")
     return GEN_RECETTE_SEL_CONVIVES
 
+@instrumented("handler_generer_note")
+@holds_household
 async def generer_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
     note= update.message.text.strip()
     context.user_data["note"]= note
-
-    stock= get_grocy_stock()
+    sel= context.user_data.get("convives_sel",[])
+    nbC= context.user_data.get("nb_convives",1)
+    days= context.user_data.pop("plan_days", None)
+    if days:
+        return await generate_meal_plan(update, context, sel, nbC, note, days)
+    return await generate_recipe(update, context, sel, nbC, note)
+
+async def generate_recipe(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                          sel:list, nbC:int, note:str, regenerate:bool=False):
+    """Génère (ou ressort du cache) la recette ; regenerate=True ignore le cache."""
+    context.user_data["last_recipe"]= {"convives": list(sel), "nb": nbC, "note": note}
+
+    hh= household_of(update)
+    stock= await hh.get_stock()
     if not stock:
-        await update.message.reply_text(TEXTS[LANGUAGE]["no_stock_found"])
+        await reply(update, TEXTS[LANGUAGE]["no_stock_found"])
         # renvoit le menu
     else:
         # Affichage partiel
-        p= f"Exemple de votre stock (total {len(stock)} produits)\n"
+        p= stale_notice(hh)+ f"Exemple de votre stock (total {len(stock)} produits)\n"
         for s in stock[:5]:
-            bc_join= ", ".join(s["barcodes"])
-            p+= f"- {s['product_name']} (Qté:{s['amount']}, Code-Barres:{bc_join})\n"
-        await update.message.reply_text(p)
+            bc_join= ", ".join(s.barcodes)
+            p+= f"- {s.product_name} (Qté:{s.amount}, Code-Barres:{bc_join})\n"
+        await reply(update, p)
+
+    sel_lower= {n.lower() for n in sel}
+    convs= [c for c in read_convives(hh.convives) if c["name"].lower() in sel_lower]
+    key= recipe_cache_key(stock, convs, note, nbC)
+    cached= None if regenerate else recipe_cache.get(key)
+    if cached:
+        logger.info(f"[Recettes] Cache hit ({key[:12]})")
+        await telegram_send_long_message(context, update.effective_chat.id, cached)
+        await reply(update, TEXTS[LANGUAGE]["recipe_cached"],
+            reply_markup=get_main_menu()
+        )
+        return MAIN_MENU
 
-    sel= context.user_data.get("convives_sel",[])
-    nbC= context.user_data.get("nb_convives",1)
-    await update.message.reply_text(TEXTS[LANGUAGE]["recipe_generation"])
-    rep= call_openai_chatgpt(stock, sel, note, nbC)
-    if rep:
-        # Envoi en plusieurs morceaux si besoin
-        await telegram_send_long_message(context, update.effective_chat.id, rep)
-    else:
-        await update.message.reply_text("❌ Pas de réponse ChatGPT.")
+    await reply(update, TEXTS[LANGUAGE]["recipe_generation"])
+    # Ordre de péremption précalculé, filtré selon les exclusions des convives
+    # choisis (mémorisé par combinaison) : le filtre conserve l'ordre, pas de re-tri
+    usable= hh.exclusions.filter(hh.expiry_index.ranked(stock), convs)
+    terms= guests_exclusions(convs) if PROMPT_INCLUDE_EXCLUSIONS else None
+    prompt= build_recipe_prompt(usable, sel, note, nbC, exclusions=terms, ranked=True)
+    # Affichage progressif, puis envoi en plusieurs morceaux si besoin
+    async def announce(pos:int):
+        await reply(update, TEXTS[LANGUAGE]["llm_queued"].format(pos=pos))
+    chunks= stream_openai_chatgpt(prompt, update.effective_chat.id, on_queued=announce)
+    rep= await telegram_stream_message(context, update.effective_chat.id, chunks)
+    if not rep:
+        await reply(update, "❌ Pas de réponse ChatGPT.")
+    elif not rep.endswith(OPENAI_ERRORS):
+        recipe_cache.put(key, rep)
+
+    await reply(update, TEXTS[LANGUAGE]["start_menu_label"], reply_markup=get_main_menu())
+    return MAIN_MENU
 
-    await update.message.reply_text(TEXTS[LANGUAGE]["start_menu_label"])
+# -------------------------------------------------------------------
+# Planning semaine
+# -------------------------------------------------------------------
+@instrumented("handler_plan_nb_jours")
+@holds_household
+async def plan_nb_jours(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    c= update.message.text.strip()
+    if not c.isdigit() or not 1<= int(c)<= PLAN_MAX_DAYS:
+        await reply(update, TEXTS[LANGUAGE]["plan_days"].format(max=PLAN_MAX_DAYS))
+        return PLAN_NB_JOURS
+    # Ensuite même parcours que pour une recette (convives puis note)
+    context.user_data["plan_days"]= int(c)
+    await reply(update, "Combien de convives ?")
+    return GEN_RECETTE_NB_CONVIVES
+
+async def generate_meal_plan(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                             sel:list, nbC:int, note:str, days:int):
+    """Génère les recettes des `days` jours en parallèle (OPENAI_PLAN_CONCURRENCY) puis la liste de courses."""
+    hh= household_of(update)
+    stock= await hh.get_stock()
+    if not stock:
+        await reply(update, TEXTS[LANGUAGE]["no_stock_found"])
+
+    sel_lower= {n.lower() for n in sel}
+    convs= [c for c in read_convives(hh.convives) if c["name"].lower() in sel_lower]
+    usable= hh.exclusions.filter(hh.expiry_index.ranked(stock), convs)
+    terms= guests_exclusions(convs) if PROMPT_INCLUDE_EXCLUSIONS else None
+    prompts= build_plan_prompts(usable, sel, note, nbC, days, exclusions=terms, ranked=True)
+    await reply(update, stale_notice(hh)+ TEXTS[LANGUAGE]["plan_generation"].format(days=days))
+
+    chat_id= update.effective_chat.id
+    sem= asyncio.Semaphore(OPENAI_PLAN_CONCURRENCY)
+    async def one(day:int):
+        async with sem:
+            return day, await complete_openai_chatgpt(prompts[day], chat_id)
+
+    shopping: List[List[str]]= [[] for _ in range(days)]
+    # Chaque jour est envoyé dès qu'il est prêt
+    for fut in asyncio.as_completed([one(d) for d in range(days)]):
+        day, rep= await fut
+        text, shopping[day]= split_shopping_list(rep)
+        title= TEXTS[LANGUAGE]["plan_day_title"].format(day=day+ 1, days=days)
+        await telegram_send_long_message(context, chat_id, f"{title}\n\n{text or '❌ Pas de réponse ChatGPT.'}")
+
+    merged= merge_shopping_lists(shopping)
+    if merged:
+        msg= TEXTS[LANGUAGE]["plan_shopping_title"]+ "\n"+ "\n".join(f"- {it}" for it in merged)
+    else:
+        msg= TEXTS[LANGUAGE]["plan_shopping_none"]
+    await telegram_send_long_message(context, chat_id, msg)
+    await reply(update, TEXTS[LANGUAGE]["start_menu_label"], reply_markup=get_main_menu())
     return MAIN_MENU
 
+# -------------------------------------------------------------------
+# /import : inventaire en masse (liste collée ou fichier CSV)
+# -------------------------------------------------------------------
+def parse_import_quantity(token:str)->Optional[Tuple[str, float]]:
+    """'+3' / '3' -> ('+', 3), '-2' -> ('-', 2), '=5' -> ('=', 5) ; None si illisible (ou +0 / -0)."""
+    token= token.strip().replace(",", ".")
+    op= "+"
+    if token and token[0] in "+-=":
+        op, token= token[0], token[1:].strip()
+    try:
+        qty= float(token)
+    except ValueError:
+        return None
+    if qty< 0 or not math.isfinite(qty) or (qty== 0 and op!= "="):
+        return None
+    return op, qty
+
+# Intitulés de colonnes reconnus (normalisés) pour ignorer une ligne d'en-tête CSV
+IMPORT_HEADER_WORDS= {
+    "produit", "product", "producto", "nom", "name", "nombre", "article", "item",
+    "code", "barcode", "code-barres", "code barres", "ean",
+    "quantite", "quantity", "cantidad", "qte", "qty", "amount", "stock",
+}
+
+def is_import_header(row:List[str])->bool:
+    """Ligne d'en-tête : toutes ses colonnes sont des intitulés connus ("Produit;Quantité")."""
+    return bool(row) and all(normalize_term(c) in IMPORT_HEADER_WORDS for c in row)
+
+def parse_import_lines(text:str)->Tuple[List[tuple], List[tuple]]:
+    """
+    Lignes « code-barres ou nom ; quantité » (séparateur ; , tabulation, ou
+    espace avant la quantité). Renvoie (lignes valides (n°, texte, produit, op, qté),
+    lignes invalides (n°, texte)). Une première ligne d'en-tête (is_import_header)
+    est ignorée ; toute autre ligne illisible, même la première, est signalée.
+    """
+    valid= []
+    invalid= []
+    for num, raw in enumerate(text.splitlines(), 1):
+        line= raw.strip()
+        if not line or line.startswith("#"):
+            continue
+        sep= ";" if ";" in line else "\t" if "\t" in line else None
+        if sep:
+            row= next(csv.reader([line], delimiter=sep))
+        else:
+            # "Riz 1,5" : quantité après le dernier espace ; sinon CSV à virgules ("Riz,2")
+            row= line.rsplit(None, 1)
+            if (len(row)< 2 or parse_import_quantity(row[-1]) is None) and "," in line:
+                row= next(csv.reader([line]))
+        row= [c.strip() for c in row if c.strip()]
+        parsed= parse_import_quantity(row[-1]) if len(row)>= 2 else None
+        if parsed is None:
+            if not valid and not invalid and is_import_header(row):
+                continue  # en-tête CSV
+            invalid.append((num, line))
+            continue
+        valid.append((num, line, " ".join(row[:-1]).strip(" ,;"), parsed[0], parsed[1]))
+    return valid, invalid
+
+def resolve_import_product(index:StockSearchIndex, ref:str)->Tuple[Optional[StockItem], str]:
+    """
+    Correspondance EXACTE uniquement (une écriture sur un produit approchant
+    serait pire qu'une ligne rejetée) : code-barres (et ses variantes à zéros)
+    pour une référence numérique, sinon nom normalisé identique.
+    """
+    if ref.isdigit():
+        found= {}
+        for v in barcode_variants(ref):
+            for p in index.lookup_barcode(v):
+                found[str(p.product_id)]= p
+        if len(found)== 1:
+            return next(iter(found.values())), ""
+        return None, "import_ambiguous" if found else "import_not_found"
+    exact= index.lookup_name(ref)
+    if len(exact)== 1:
+        return exact[0], ""
+    return None, "import_ambiguous" if exact else "import_not_found"
+
+async def run_import(hh:"Household", text:str)->str:
+    """Résout toutes les lignes sur l'index, écrit en parallèle (IMPORT_CONCURRENCY) et renvoie le bilan."""
+    T= TEXTS[LANGUAGE]
+    valid, invalid= parse_import_lines(text)
+    notes= []
+    if len(valid)> IMPORT_MAX_LINES:
+        notes.append(T["import_too_long"].format(max=IMPORT_MAX_LINES))
+        valid= valid[:IMPORT_MAX_LINES]
+    errors= [(num, line, T["import_bad_line"]) for num, line in invalid]
+
+    await hh.get_stock()
+    # Regroupement par produit : les lignes s'appliquent dans l'ordre ("=" puis "+" = absolu)
+    plan: "OrderedDict[str, dict]"= OrderedDict()
+    for num, line, ref, op, qty in valid:
+        p, reason= resolve_import_product(hh.stock_index, ref)
+        if p is None:
+            errors.append((num, line, T[reason]))
+            continue
+        entry= plan.setdefault(str(p.product_id), {"item": p, "absolute": None, "delta": 0.0, "lines": []})
+        entry["lines"].append((num, line))
+        if op== "=":
+            entry["absolute"], entry["delta"]= qty, 0.0
+        else:
+            entry["delta"]+= qty if op== "+" else -qty
+
+    skipped= len(errors)
+    sem= asyncio.Semaphore(IMPORT_CONCURRENCY)
+    async def apply(pid:str, entry:dict)->Tuple[bool, Optional[str]]:
+        """(succès, remarque pour les lignes du produit)."""
+        async with sem:
+            p= entry["item"]
+            if entry["absolute"] is not None:
+                ok= await update_grocy_product(hh.client, pid, max(0.0, entry["absolute"]+ entry["delta"]))
+                return ok, None
+            # Quantité demandée telle quelle : Grocy (stock réel) décide, pas le snapshot
+            delta= entry["delta"]
+            applied= await apply_grocy_delta(hh.client, pid, delta, GROCY_WRITE_RETRIES, 1.0)
+            if applied is None:
+                logger.error(f"[Import] {p.product_name}: écriture non confirmée")
+                metrics.error("import")
+                return False, None
+            if applied!= delta:
+                return True, T["import_partial"].format(done=-applied, asked=-delta)
+            return True, None
+
+    results= await asyncio.gather(*(apply(pid, e) for pid, e in plan.items()))
+    if plan:
+        hh.stock_cache.invalidate()
+    ok= 0
+    for entry, (res, note) in zip(plan.values(), results):
+        if res:
+            ok+= 1
+            if note:
+                errors.extend((num, line, note) for num, line in entry["lines"])
+        else:
+            errors.extend((num, line, T["import_failed"]) for num, line in entry["lines"])
+
+    failed= len(plan)- ok
+    lines= notes+ [T["import_summary"].format(ok=ok, failed=failed, skipped=skipped)]
+    for num, line, reason in sorted(errors):
+        lines.append(f"- L{num} « {line} » : {reason}")
+    logger.info(f"[Import] {ok} OK, {failed} échecs, {skipped} ignorées ({len(valid)} lignes)")
+    return "\n".join(lines)
+
+@instrumented("handler_import_handler")
+@holds_household
+async def import_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    parts= update.message.text.split(None, 1)  # "/import" puis la liste (même ligne ou suivantes)
+    text= parts[1] if len(parts)> 1 else ""
+    if not text.strip():
+        # Un fichier .csv envoyé ensuite (en privé) sera importé
+        context.user_data["import_pending"]= time.time()
+        await reply(update, TEXTS[LANGUAGE]["import_usage"])
+        return
+    context.user_data.pop("import_pending", None)
+    await _import_and_report(update, context, text)
+
+@instrumented("handler_import_document_handler")
+@holds_household
+async def import_document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Fichier .csv en conversation privée => même traitement que /import, mais
+    seulement s'il a la légende /import ou répond à un /import sans liste :
+    un fichier déposé sans intention d'import n'écrit jamais dans Grocy.
+    """
+    words= (update.message.caption or "").split(None, 1)
+    captioned= bool(words) and words[0].lower().split("@", 1)[0]== "/import"
+    pending= time.time()- context.user_data.pop("import_pending", 0)< IMPORT_PENDING_TIMEOUT
+    if not (captioned or pending):
+        await reply(update, TEXTS[LANGUAGE]["import_csv_hint"])
+        return
+    f= await update.message.document.get_file()
+    data= bytes(await f.download_as_bytearray())
+    await _import_and_report(update, context, data.decode("utf-8-sig", errors="replace"))
+
+async def _import_and_report(update: Update, context: ContextTypes.DEFAULT_TYPE, text:str):
+    hh= household_of(update)
+    n= sum(1 for l in text.splitlines() if l.strip())
+    await reply(update, TEXTS[LANGUAGE]["import_running"].format(n=n))
+    summary= await run_import(hh, text)
+    await telegram_send_long_message(context, update.effective_chat.id, stale_notice(hh)+ summary)
+
+# -------------------------------------------------------------------
+# /expiring [jours]
+# -------------------------------------------------------------------
+@instrumented("handler_expiring_handler")
+@holds_household
+async def expiring_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    days= EXPIRY_RISK_DAYS
+    if context.args:
+        if not context.args[0].isdigit():
+            await reply(update, TEXTS[LANGUAGE]["expiring_usage"])
+            return
+        days= int(context.args[0])
+
+    hh= household_of(update)
+    stock= await hh.get_stock()
+    if not stock:
+        await reply(update, TEXTS[LANGUAGE]["no_stock_found"])
+        return
+    hh.expiry_index.ensure(stock)
+    items= hh.expiry_index.expiring(days)
+    if not items:
+        await reply(update, TEXTS[LANGUAGE]["expiring_none"].format(days=days))
+        return
+    lines= [stale_notice(hh)+ TEXTS[LANGUAGE]["expiring_title"].format(days=days)]
+    for p, left in items:
+        when= f"J{left:+d}" if left else "J0"
+        lines.append(f"- {p.product_name} (Qté:{p.amount}, {p.best_before_date}, {when})")
+    await telegram_send_long_message(context, update.effective_chat.id, "\n".join(lines))
+
+# -------------------------------------------------------------------
+# /stats (compteurs du cache stock et des prompts)
+# -------------------------------------------------------------------
+@instrumented("handler_stats_handler")
+@holds_household
+async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    hh= household_of(update)
+    st= hh.stock_cache.stats()
+    msg= (
+        f"📊 Cache stock Grocy (foyer {hh.name}, {len(households.active())} actif(s))\n"
+        f"Hits: {st['hits']} | Misses: {st['misses']} | Ratio: {st['hit_ratio']}\n"
+        f"TTL: {st['ttl']}s | Produits en cache: {st['items']} | Stock périmé servi: {st['stale_served']}"
+    )
+    ps= prompt_stats.stats()
+    msg+= (
+        "\n\n🧾 Prompts recette\n"
+        f"Requêtes: {ps['requests']} | Tokens (dernier/moyen): {ps['last_tokens']}/{ps['avg_tokens']}\n"
+        f"Produits envoyés (dernier): {ps['last_items']}"
+    )
+    rs= recipe_cache.stats()
+    msg+= (
+        "\n\n♻️ Cache recettes\n"
+        f"Hits: {rs['hits']} | Misses: {rs['misses']} | Entrées: {rs['entries']}"
+    )
+    await reply(update, msg)
+
 # -------------------------------------------------------------------
 # conv_handler
 # -------------------------------------------------------------------
 conv_handler= ConversationHandler(
     entry_points=[
         MessageHandler(filters.TEXT & ~filters.COMMAND, fallback_handler),
+        MessageHandler(filters.PHOTO, photo_handler),
         CommandHandler("start", start_handler)
     ],
     states={
@@ -661,25 +3682,202 @@ conv_handler= ConversationHandler(
         ],
         SEARCH_GROCY_QUANTITY: [
             MessageHandler(filters.TEXT & ~filters.COMMAND, search_grocy_quantity_handler)
+        ],
+        PLAN_NB_JOURS: [
+            MessageHandler(filters.TEXT & ~filters.COMMAND, plan_nb_jours)
         ]
     },
-    fallbacks=[CommandHandler("start", start_handler)]
+    fallbacks=[CommandHandler("start", start_handler)],
+    name="stocktoplate_conv",
+    persistent=True
 )
 
+# -------------------------------------------------------------------
+# Webhook : traitement concurrent, ordonné par chat
+# -------------------------------------------------------------------
+class ChatOrderedDispatcher:
+    """
+    Traite les updates avec `workers` tâches en parallèle, tout en gardant
+    l'ordre au sein d'un même chat (le conv_handler en dépend) : un chat n'a
+    jamais plus d'une update en cours. Chaque chat a sa file ; les chats prêts
+    passent à tour de rôle. La file globale est bornée (backpressure).
+    """
+    def __init__(self, application: Application, workers:int, max_queued:int, enqueue_timeout:float):
+        self.application= application
+        self.workers= workers
+        self.enqueue_timeout= enqueue_timeout
+        self._slots= asyncio.Semaphore(max_queued)
+        self._pending: Dict[object, deque]= {}
+        self._ready: asyncio.Queue= asyncio.Queue()
+        self._tasks: List[asyncio.Task]= []
+
+    @staticmethod
+    def _key(update: Update):
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return ("user", update.effective_user.id)
+        return ("update", update.update_id)
+
+    def start(self):
+        self._tasks= [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks= []
+
+    def queued(self)->int:
+        return sum(len(d) for d in self._pending.values())
+
+    async def submit(self, update: Update)->bool:
+        """Met l'update en file ; False si la file reste pleine (l'appelant répond 503)."""
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            return False
+        key= self._key(update)
+        dq= self._pending.get(key)
+        if dq is None:
+            self._pending[key]= deque([update])
+            self._ready.put_nowait(key)
+        else:
+            dq.append(update)
+        return True
+
+    async def _worker(self):
+        while True:
+            key= await self._ready.get()
+            dq= self._pending[key]
+            update= dq.popleft()
+            try:
+                await self.application.process_update(update)
+            except Exception as e:
+                logger.error(f"[Webhook] Erreur traitement update {update.update_id}: {e}")
+            finally:
+                self._slots.release()
+                if dq:
+                    # Chat remis en fin de tour : équité entre chats
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+
+async def run_webhook(application: Application):
+    """
+    Reçoit les updates par webhook (mini serveur HTTP) au lieu du polling.
+    Toute requête sans le bon en-tête secret est refusée : sans WEBHOOK_SECRET,
+    un secret aléatoire est généré et transmis à Telegram par set_webhook.
+    """
+    secret= WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    dispatcher= ChatOrderedDispatcher(
+        application, UPDATE_WORKERS, UPDATE_QUEUE_SIZE, UPDATE_ENQUEUE_TIMEOUT
+    )
+    metrics.gauge("updates_queued", dispatcher.queued)
+
+    async def webhook_handler(method:str, path:str, headers:Dict[str, str], body:bytes):
+        if method!= "POST" or path.split("?")[0]!= WEBHOOK_PATH:
+            return 404, "text/plain", b"not found"
+        if not secrets.compare_digest(
+            headers.get("x-telegram-bot-api-secret-token", "").encode("utf-8"), secret.encode("utf-8")
+        ):
+            return 403, "text/plain", b"forbidden"
+        update= Update.de_json(json.loads(body), application.bot)
+        if not await dispatcher.submit(update):
+            logger.warning("[Webhook] File pleine, update refusée (Telegram la renverra)")
+            return 503, "text/plain", b"busy"
+        return 200, "text/plain", b"ok"
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    dispatcher.start()
+    server= await start_http_server(WEBHOOK_LISTEN, WEBHOOK_PORT, webhook_handler)
+    await application.bot.set_webhook(
+        url=WEBHOOK_URL, secret_token=secret, drop_pending_updates=True
+    )
+    logger.info(f"[Webhook] En écoute sur {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH} ({UPDATE_WORKERS} workers)")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.close()
+        await dispatcher.stop()
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
 # -------------------------------------------------------------------
 # main
 # -------------------------------------------------------------------
-async def main():
-    # Initialise le CSV convives
-    init_csv_file(CONVIVES_CSV)
+services: Dict[str, object]= {}   # serveurs / tâches de fond démarrés au lancement
+
+async def on_startup(application: Application):
+    """Démarre la surveillance des changements Grocy (et précharge le stock) et les métriques."""
+    # Le foyer par défaut est ouvert d'emblée ; les autres à leur premier message
+    households.get(None)
+    barcode_scanner.start()
+    metrics.gauge("households_active", lambda: len(households.active()))
+    metrics.gauge("stock_cache_hits", lambda: sum(hh.stock_cache.hits for hh in households.active()))
+    metrics.gauge("stock_cache_misses", lambda: sum(hh.stock_cache.misses for hh in households.active()))
+    metrics.gauge("stock_items", lambda: sum(hh.cached_items() for hh in households.active()))
+    metrics.gauge("llm_queued", llm_scheduler.queued)
+    metrics.gauge("telegram_queued", telegram_sender.queued)
+    metrics.gauge("recipe_cache_hits", lambda: recipe_cache.hits)
+    metrics.gauge("recipe_cache_misses", lambda: recipe_cache.misses)
+    if METRICS_PORT:
+        services["metrics_server"]= await start_http_server(
+            METRICS_HOST, METRICS_PORT, metrics_http_handler
+        )
+        logger.info(f"[Metrics] http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    if METRICS_LOG_INTERVAL:
+        services["metrics_log_task"]= asyncio.create_task(metrics_log_loop(METRICS_LOG_INTERVAL))
+
+async def on_shutdown(application: Application):
+    """Termine les écritures en file puis ferme connexions HTTP et bases convives de chaque foyer."""
+    task= services.pop("metrics_log_task", None)
+    if task is not None:
+        task.cancel()
+    server= services.pop("metrics_server", None)
+    if server is not None:
+        server.close()
+    await llm_scheduler.stop()
+    await telegram_sender.stop()
+    barcode_scanner.shutdown()
+    await households.close_all()
 
-    application= Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+async def main():
+    recipe_cache.load()
+
+    application= (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .persistence(PicklePersistence(
+            filepath=CONVERSATION_STATE_FILE,
+            # Seuls les états de conversation et user_data (compacts) sont utiles
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False)
+        ))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    application.add_handler(CommandHandler("stats", stats_handler))
+    application.add_handler(CommandHandler("expiring", expiring_handler))
+    application.add_handler(CommandHandler("import", import_handler))
+    application.add_handler(MessageHandler(
+        filters.ChatType.PRIVATE & filters.Document.FileExtension("csv"), import_document_handler
+    ))
+    application.add_handler(CallbackQueryHandler(search_page_handler, pattern=r"^page:\d+$"))
     application.add_handler(conv_handler)
 
     logger.info("Bot en train de se lancer... ✅")
 
-    # On ignore l'historique
-    await application.run_polling(drop_pending_updates=True)
+    if WEBHOOK_URL:
+        await run_webhook(application)
+    else:
+        # On ignore l'historique
+        await application.run_polling(drop_pending_updates=True)
 
 if __name__== "__main__":
     asyncio.run(main())
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmarks des chemins critiques de StockToPlate.py :
+- get_grocy_stock (téléchargement + parsing) contre un faux serveur Grocy local ;
+- recherche : parcours linéaire match_all_words vs index inversé ;
+- construction du prompt recette ;
+- appel OpenAI (streaming) contre un faux endpoint local ;
+- opérations convives (ajout / modification / lecture / suppression).
+
+Stocks synthétiques de 100 à 100 000 produits. Résultats : percentiles de
+latence (p50/p90/p99, ms) et pic mémoire (tracemalloc, Ko), comparés à une
+baseline JSON pour détecter les régressions.
+
+Usage :
+    python benchmarks/bench_stocktoplate.py                     # compare à la baseline si elle existe
+    python benchmarks/bench_stocktoplate.py --save-baseline     # enregistre la baseline
+    python benchmarks/bench_stocktoplate.py --sizes 100,1000 --iterations 20
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE= os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import openai
+import StockToPlate as stp
+
+DEFAULT_BASELINE= os.path.join(HERE, "baseline.json")
+DEFAULT_SIZES= [100, 1000, 10000, 100000]
+QUERIES= ["a", "ri", "lait", "pâtes com", "3017", "aucun code"]
+
+WORDS= [
+    "lait", "riz", "pâtes", "sucre", "farine", "tomate", "pomme", "beurre", "oeuf", "jambon",
+    "yaourt", "café", "thé", "chocolat", "miel", "huile", "vinaigre", "sel", "poivre", "carotte",
+    "complet", "bio", "demi", "écrémé", "nature", "fumé", "vanille", "entier", "surgelé", "frais",
+]
+
+# -------------------------------------------------------------------
+# Données synthétiques
+# -------------------------------------------------------------------
+def synthetic_stock(n: int, seed: int= 42)->list:
+    """Réponse brute GET /api/stock avec n produits."""
+    rnd= random.Random(seed)
+    data= []
+    for i in range(n):
+        name= " ".join(rnd.sample(WORDS, rnd.randint(1, 3))).capitalize()+ f" {i}"
+        nb_bc= rnd.choice([0, 1, 1, 2])
+        barcodes= [str(3017000000000+ rnd.randrange(10**9)) for _ in range(nb_bc)]
+        data.append({
+            "product_id": i+ 1,
+            "amount": rnd.randint(0, 12),
+            "best_before_date": f"2026-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}"
+                if rnd.random()< 0.9 else "2999-12-31",
+            "product": {"name": name, "barcodes": barcodes, "picture_file_name": None},
+        })
+    return data
+
+# -------------------------------------------------------------------
+# Faux serveurs Grocy / OpenAI
+# -------------------------------------------------------------------
+class FakeServers:
+    """Grocy (/api/stock, db-changed-time, add/consume) et OpenAI (/v1/chat/completions)."""
+    RECIPE= "🍽️ Recette de test : " + "étape suivante. "* 60
+
+    def __init__(self):
+        self.stock_body= b"[]"
+        servers= self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version= "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, body: bytes, ctype: str= "application/json"):
+                self.send_response(200)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.startswith("/api/stock"):
+                    self._send(servers.stock_body)
+                elif self.path.startswith("/api/system/db-changed-time"):
+                    self._send(b'{"changed_time": "2026-01-01 00:00:00"}')
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                body= self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path.startswith("/v1/chat/completions"):
+                    req= json.loads(body or b"{}")
+                    if req.get("stream"):
+                        chunks= []
+                        for i in range(0, len(servers.RECIPE), 40):
+                            delta= {"choices": [{"index": 0, "delta": {"content": servers.RECIPE[i:i+40]}}]}
+                            chunks.append(f"data: {json.dumps(delta)}\n\n")
+                        chunks.append("data: [DONE]\n\n")
+                        self._send("".join(chunks).encode("utf-8"), "text/event-stream")
+                    else:
+                        self._send(json.dumps({"choices": [{"message": {"content": servers.RECIPE}}]}).encode())
+                else:
+                    self._send(b"{}")
+
+        self.httpd= ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url= f"http://127.0.0.1:{self.httpd.server_port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def set_stock(self, data: list):
+        self.stock_body= json.dumps(data).encode("utf-8")
+
+    def close(self):
+        self.httpd.shutdown()
+
+# -------------------------------------------------------------------
+# Mesures
+# -------------------------------------------------------------------
+def percentile(values: list, q: float)->float:
+    s= sorted(values)
+    k= (len(s)- 1)* q
+    lo= int(k)
+    hi= min(lo+ 1, len(s)- 1)
+    return s[lo]+ (s[hi]- s[lo])* (k- lo)
+
+def measure(fn, iterations: int)->dict:
+    """Exécute fn() `iterations` fois ; fn peut être une coroutine."""
+    loop= asyncio.get_event_loop()
+    def run():
+        res= fn()
+        if asyncio.iscoroutine(res):
+            loop.run_until_complete(res)
+    run()  # échauffement (connexions, caches de tokenizer...)
+    times= []
+    for _ in range(iterations):
+        t0= time.perf_counter()
+        run()
+        times.append((time.perf_counter()- t0)* 1000)
+    tracemalloc.start()
+    run()
+    _, peak= tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "p50_ms": round(percentile(times, 0.50), 3),
+        "p90_ms": round(percentile(times, 0.90), 3),
+        "p99_ms": round(percentile(times, 0.99), 3),
+        "peak_kb": round(peak/ 1024, 1),
+    }
+
+def iterations_for(size: int, base: int)->int:
+    return max(3, base* 1000// max(size, 1000))
+
+def run_benchmarks(sizes: list, base_iterations: int)->dict:
+    results= {}
+    srv= FakeServers()
+    client= stp.GrocyClient(srv.url, "bench", timeout=10, max_retries=0, backoff=0, max_concurrency=4)
+    openai.api_base= srv.url+ "/v1"
+    try:
+        for size in sizes:
+            it= iterations_for(size, base_iterations)
+            raw= synthetic_stock(size)
+            srv.set_stock(raw)
+
+            results[f"get_grocy_stock[{size}]"]= measure(lambda: stp.get_grocy_stock(client), it)
+            results[f"parse_grocy_stock[{size}]"]= measure(lambda: stp.parse_grocy_stock(raw), it)
+
+            stock= stp.parse_grocy_stock(raw)
+            queries= [q.lower().split() for q in QUERIES]
+            results[f"match_all_words[{size}]"]= measure(
+                lambda: [[p for p in stock if stp.match_all_words(p, w)]
+                         for w in queries],
+                it
+            )
+            def build_index():
+                stp.StockSearchIndex().ensure(stock)
+            results[f"index_build[{size}]"]= measure(build_index, max(3, it// 5))
+            idx= stp.StockSearchIndex()
+            idx.ensure(stock)
+            results[f"index_search[{size}]"]= measure(lambda: [idx.search(w) for w in queries], it)
+
+            expiry= stp.ExpiryIndex()
+            expiry.ensure(stock)
+            results[f"build_recipe_prompt[{size}]"]= measure(
+                lambda: stp.build_recipe_prompt(stock, ["Bob", "Alice"], "Protéines", 2, expiry=expiry), it
+            )
+
+        # Ordonnanceur sans limite effective : OPENAI_RPM ferait attendre ~1 s par appel
+        # au-delà d'une minute de quota et fausserait la latence mesurée
+        stp.llm_scheduler= stp.LLMScheduler(10** 9, 10** 12)
+        results["call_openai_chatgpt[stub]"]= measure(
+            lambda: stp.call_openai_chatgpt([], ["Bob"], "Rapide", 1), base_iterations
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            store= stp.ConvivesStore(os.path.join(tmp, "bench.db"))
+            for i in range(200):
+                store.add(f"Convive{i}")
+            counter= [0]
+            def convives_cycle():
+                counter[0]+= 1
+                nom= f"Bench{counter[0]}"
+                stp.ajouter_convive(nom, store)
+                stp.modifier_aliments_convive(nom, "gluten, lactose", store)
+                stp.read_convives(store)
+                stp.supprimer_convive(nom, store)
+            results["convives_cycle[200]"]= measure(convives_cycle, base_iterations* 5)
+            store.close()
+    finally:
+        loop= asyncio.get_event_loop()
+        loop.run_until_complete(client.aclose())
+        loop.run_until_complete(stp.llm_scheduler.stop())
+        srv.close()
+    return results
+
+# -------------------------------------------------------------------
+# Baseline
+# -------------------------------------------------------------------
+def compare(results: dict, baseline: dict, tolerance: float)->list:
+    """Renvoie les régressions (p50 > baseline * (1 + tolerance))."""
+    regressions= []
+    for name, cur in results.items():
+        ref= baseline.get(name)
+        if not ref or not ref.get("p50_ms"):
+            continue
+        ratio= cur["p50_ms"]/ ref["p50_ms"]
+        if ratio> 1+ tolerance:
+            regressions.append((name, ref["p50_ms"], cur["p50_ms"], ratio))
+    return regressions
+
+def print_table(results: dict, baseline: dict):
+    print(f"{'benchmark':<34}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'pic Ko':>11}{'vs base':>9}")
+    for name, r in results.items():
+        ref= baseline.get(name, {}).get("p50_ms")
+        delta= f"{r['p50_ms']/ ref:>8.2f}x" if ref else f"{'-':>9}"
+        print(f"{name:<34}{r['p50_ms']:>10.3f}{r['p90_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['peak_kb']:>11.1f}{delta}")
+
+def main()->int:
+    ap= argparse.ArgumentParser(description="Micro-benchmarks StockToPlate")
+    ap.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                    help="tailles de stock, séparées par des virgules")
+    ap.add_argument("--iterations", type=int, default=30, help="itérations de base (réduites pour les gros stocks)")
+    ap.add_argument("--baseline", default=DEFAULT_BASELINE, help="fichier JSON de baseline")
+    ap.add_argument("--save-baseline", action="store_true", help="enregistre les résultats comme baseline")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="régression tolérée sur le p50 (0.25 = +25%%)")
+    ap.add_argument("--json", help="écrit aussi les résultats bruts dans ce fichier")
+    args= ap.parse_args()
+
+    logging.getLogger("StockToPlate").setLevel(logging.WARNING)
+    logging.getLogger("openai").setLevel(logging.WARNING)
+    sizes= [int(x) for x in args.sizes.split(",") if x.strip()]
+    results= run_benchmarks(sizes, args.iterations)
+
+    baseline= {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline= json.load(f)
+    print_table(results, baseline)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"\nBaseline enregistrée : {args.baseline}")
+        return 0
+
+    regressions= compare(results, baseline, args.tolerance)
+    for name, ref, cur, ratio in regressions:
+        print(f"❌ Régression {name}: {ref:.3f} ms -> {cur:.3f} ms ({ratio:.2f}x)")
+    if baseline and not regressions:
+        print("\n✅ Aucune régression par rapport à la baseline.")
+    return 1 if regressions else 0
+
+if __name__== "__main__":
+    sys.exit(main())